@@ -0,0 +1,200 @@
+"""
+Benchmark the storage backends through the KVContainer API with the documents of the plugins.
+
+Every run fills a fresh vtubers and states table of the given size, then times each workload with concurrent tasks
+and reports its throughput and latency percentiles. Write workloads include the final flush, so backends deferring
+their writes are not measured by their buffering alone.
+
+Run from the repository root, e.g.
+    python benchmarks/storage.py --sizes 100 1000 --concurrency 1 16
+MongoDB is benchmarked against --mongo, or mongomock_motor if it is installed and no server is given.
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import string
+import sys
+import tempfile
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+from urllib.parse import urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pystargazer.app import app  # noqa: E402
+from pystargazer.models import KVContainer, KVPair  # noqa: E402
+
+SINCE_TTL = 30 * 24 * 3600
+
+
+def random_id(length: int) -> str:
+    return "".join(random.choices(string.ascii_letters + string.digits, k=length))
+
+
+def vtuber_doc(i: int) -> dict:
+    doc = {
+        "title": f"Talent {i}",
+        "twitter": f"talent_{i}",
+        "youtube": f"UC{random_id(22)}",
+        "avatar": f"https://pbs.twimg.com/profile_images/{random.getrandbits(60)}/{random_id(8)}_400x400.jpg"
+    }
+    # not every talent streams on bilibili
+    if i % 3:
+        doc["bilibili"] = str(10000000 + i)
+    return doc
+
+
+def video_doc() -> dict:
+    video_id = random_id(11)
+    return {
+        "video_id": video_id,
+        "title": " ".join(random_id(random.randint(3, 10)) for _ in range(8)),
+        "link": f"https://www.youtube.com/watch?v={video_id}",
+        "type": "BROADCAST",
+        "description": " ".join(random_id(random.randint(3, 10)) for _ in range(80)),
+        "thumbnail": f"https://i.ytimg.com/vi/{video_id}/hqdefault_live.jpg",
+        "scheduled_start_time": time.time() + random.randint(0, 7 * 24 * 3600),
+        "actual_start_time": None
+    }
+
+
+def live_state_doc(channels: List[str]) -> dict:
+    # about a quarter of the channels have broadcasts scheduled at any time
+    return {channel: [video_doc() for _ in range(random.randint(1, 2))] for channel in channels[::4]}
+
+
+def since_marker(name: str) -> KVPair:
+    return KVPair(f"twitter_since:{name}", {"since": random.getrandbits(60)}).expire_in(SINCE_TTL)
+
+
+class Result:
+    def __init__(self, op: str, latencies: List[float], elapsed: float):
+        self.op = op
+        self.latencies = sorted(latencies)
+        self.elapsed = elapsed
+
+    def percentile(self, q: float) -> float:
+        return self.latencies[min(len(self.latencies) - 1, int(q * len(self.latencies)))] * 1000
+
+    def __str__(self) -> str:
+        return (f"{self.op:<22}{len(self.latencies) / self.elapsed:>10.0f}"
+                f"{self.percentile(.5):>9.2f}{self.percentile(.9):>9.2f}{self.percentile(.99):>9.2f}"
+                f"{self.latencies[-1] * 1000:>9.2f}")
+
+
+async def measure(op: str, func: Callable[[int], Awaitable], count: int, concurrency: int,
+                  flush: Optional[Callable[[], Awaitable]] = None) -> Result:
+    latencies = []
+
+    async def worker(offset: int):
+        for i in range(offset, count, concurrency):
+            start = time.perf_counter()
+            await func(i)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(offset) for offset in range(concurrency)))
+    if flush is not None:
+        await flush()
+    return Result(op, latencies, time.perf_counter() - start)
+
+
+async def run(urls: Dict[str, str], size: int, concurrency: int, ops: int, scans: int,
+              cache_size: int) -> List[Result]:
+    vtubers = KVContainer(urls["vtubers"], "vtubers", cache_size)
+    states = KVContainer(urls["states"], "states", cache_size)
+
+    names = [f"talent_{i:05}" for i in range(size)]
+    await vtubers.put_many(KVPair(name, vtuber_doc(i)) for i, name in enumerate(names))
+    await states.put_many(since_marker(name) for name in names)
+    await vtubers.flush()
+    await states.flush()
+
+    async def has_field(_):
+        async for _ in vtubers.has_field("twitter", ["twitter"]):
+            pass
+
+    # documents are generated upfront, so that only the storage calls are timed
+    get_keys = [random.choice(names) for _ in range(ops)]
+    put_objs = [KVPair(random.choice(names), vtuber_doc(i)) for i in range(ops)]
+    live_states = [KVPair("youtube_live_state", live_state_doc(names)) for _ in range(scans)]
+    since_keys = [f"twitter_since:{name}" for name in names]
+    # the since markers of a tick, written back for the talents having new tweets
+    since_batches = [[since_marker(name) for name in random.sample(names, max(size // 20, 1))] for _ in range(scans)]
+    return [
+        await measure("vtubers.get", lambda i: vtubers.get(get_keys[i]), ops, concurrency),
+        await measure("vtubers.put", lambda i: vtubers.put(put_objs[i]), ops, concurrency, vtubers.flush),
+        await measure("vtubers.has_field", has_field, scans, concurrency),
+        await measure("states.put live_state", lambda i: states.put(live_states[i]), scans, concurrency,
+                      states.flush),
+        await measure("states.get_many since", lambda i: states.get_many(since_keys), scans, concurrency),
+        await measure("states.put_many since", lambda i: states.put_many(since_batches[i]), scans, concurrency,
+                      states.flush)
+    ]
+
+
+def storage_urls(backend: str, root: str, mongo: str) -> Dict[str, str]:
+    tables = ("vtubers", "states")
+    if backend == "file":
+        return {table: f"file://{root}/db.json/{table}" for table in tables}
+    if backend == "log":
+        return {table: f"log://{root}/db.log/{table}" for table in tables}
+    if backend == "sqlite":
+        return {table: f"sqlite:///{root}/db.sqlite/{table}" for table in tables}
+    return {table: f"{mongo}/{mongo_db(root)}/{table}" for table in tables}
+
+
+def mongo_db(root: str) -> str:
+    # one database per run, dropped afterwards
+    return f"stargazer_bench_{os.path.basename(root)}"
+
+
+async def main(args: argparse.Namespace):
+    backends = list(args.backends)
+    if "mongodb" in backends and args.mongo is None:
+        try:
+            import motor.motor_asyncio
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            print("Skipping mongodb, neither --mongo nor mongomock_motor is available.")
+            backends.remove("mongodb")
+        else:
+            motor.motor_asyncio.AsyncIOMotorClient = AsyncMongoMockClient
+    mongo = args.mongo or "mongodb://localhost"
+
+    workdir = tempfile.mkdtemp(prefix="stargazer-bench-")
+    try:
+        print(f"{'':<22}{'ops/s':>10}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+        for backend in backends:
+            for size in args.sizes:
+                for concurrency in args.concurrency:
+                    root = tempfile.mkdtemp(dir=workdir)
+                    urls = storage_urls(backend, root, mongo)
+                    print(f"{backend} size={size} concurrency={concurrency}")
+                    for result in await run(urls, size, concurrency, args.ops, args.scans, args.cache_size):
+                        print(result)
+                    if backend == "mongodb":
+                        from pystargazer.storages.mongodb import get_client
+                        db = mongo_db(root)
+                        await get_client(urlparse(mongo).netloc, db).drop_database(db)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the storage backends through the KVContainer API.")
+    parser.add_argument("--backends", nargs="+", default=["file", "log", "sqlite", "mongodb"],
+                        choices=["file", "log", "sqlite", "mongodb"])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[100, 1000], help="talents in the tables")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 16], help="concurrent tasks")
+    parser.add_argument("--ops", type=int, default=2000, help="operations of the get and put workloads")
+    parser.add_argument("--scans", type=int, default=50, help="operations of the scan and state workloads")
+    parser.add_argument("--cache-size", type=int, default=0, help="STORAGE_CACHE_SIZE of the containers")
+    parser.add_argument("--mongo", help="MongoDB server url, e.g. mongodb://localhost")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    app.loop.run_until_complete(main(args))
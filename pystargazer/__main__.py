@@ -5,7 +5,9 @@ from os import environ, path
 from uvicorn.main import Config, Server
 
 from .app import app
+from .dispatch import Overflow
 from .models import KVContainer
+from .outbox import Outbox
 from .utils import strtobool
 
 debug = strtobool(environ.get("DEBUG"))
@@ -17,6 +19,17 @@ plugin_blacklist = [plugin.strip() for plugin in environ.get("PLUGIN_BLACKLIST",
 plugin_dir = environ.get("PLUGIN_DIR", None)
 telemetry = environ.get("TELEMETRY", "")
 telemetry_release = environ.get("TELEMETRY_RELEASE", None)
+dispatch_queue_size = int(environ.get("DISPATCH_QUEUE_SIZE", "256"))
+dispatch_overflow = Overflow(environ.get("DISPATCH_OVERFLOW", "block").lower())
+dedup_size = int(environ.get("EVENT_DEDUP_SIZE", "8192"))
+dedup_ttl = float(environ.get("EVENT_DEDUP_TTL", str(30 * 86400)))
+storage_cache_size = int(environ.get("STORAGE_CACHE_SIZE", "0"))
+states_write_behind = float(environ.get("STATES_WRITE_BEHIND", "0"))
+states_max_staleness = float(environ.get("STATES_MAX_STALENESS", "60"))
+hook_join_timeout = float(environ.get("HOOK_JOIN_TIMEOUT", "10"))
+outbox_dir = environ.get("OUTBOX_DIR", "data/outbox")
+outbox_max_bytes = int(environ.get("OUTBOX_MAX_BYTES", str(256 << 20)))
+outbox_max_age = float(environ.get("OUTBOX_MAX_AGE", str(7 * 86400)))
 
 if telemetry:
     import sentry_sdk
@@ -27,9 +40,18 @@ if not debug:
 else:
     logging.basicConfig(level=logging.DEBUG)
 
-app._vtubers = KVContainer(app.credentials.get("vtubers_storage"), "vtubers")
-app._configs = KVContainer(app.credentials.get("configs_storage"), "configs")
-app._states = KVContainer(app.credentials.get("plugins_storage"), "states")
+app.dispatch_queue_size = dispatch_queue_size
+app.dispatch_overflow = dispatch_overflow
+app.dedup.maxsize = dedup_size
+app.dedup.ttl = dedup_ttl
+app.hook_join_timeout = hook_join_timeout
+if outbox_dir:
+    app.outbox = Outbox(outbox_dir, max_bytes=outbox_max_bytes, max_age=outbox_max_age)
+
+app._vtubers = KVContainer(app.credentials.get("vtubers_storage"), "vtubers", storage_cache_size)
+app._configs = KVContainer(app.credentials.get("configs_storage"), "configs", storage_cache_size)
+app._states = KVContainer(app.credentials.get("plugins_storage"), "states", storage_cache_size,
+                          states_write_behind, states_max_staleness)
 
 search_path = [path for path in
                [path.join(path.dirname(path.abspath(__file__)), "plugins") if builtin_plugins else None,
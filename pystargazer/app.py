@@ -1,7 +1,9 @@
 import asyncio
+import contextvars
 import logging
+import time
 import traceback
-from typing import Awaitable, Callable, Dict, List, Optional
+from typing import Awaitable, Callable, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
 from types import ModuleType
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
@@ -9,10 +11,48 @@ from starlette.applications import Starlette
 from starlette.middleware import Middleware
 from starlette.routing import Route, WebSocketRoute
 
-from .models import Credential, Event, KVContainer, KVPair
+from .dispatch import DedupIndex, Dispatcher, Overflow, T_BatchDispatcher, T_Dispatcher
+from .models import Credential, EXPIRE_AT, Event, KVContainer, KVPair
+from .outbox import Outbox
 
 T_Life = Callable[[None], Awaitable[None]]
-T_Dispatcher = Callable[[Event], Awaitable[None]]
+T_Stats = Callable[[], dict]
+T_Hook = Callable[..., Awaitable[None]]
+
+# key prefix of the event dedup markers in the plugin state, each expiring with its entry
+DEDUP_PREFIX = "event_dedup:"
+
+# (storage, key) of the hooks running in the current task
+_running_hooks: contextvars.ContextVar[Optional[Tuple[str, str]]] = contextvars.ContextVar("running_hooks",
+                                                                                          default=None)
+
+
+class Hooks:
+    """ Storage hook callbacks of one storage, indexed by the fields they are interested in. """
+
+    def __init__(self):
+        self.callbacks: List[T_Hook] = []
+        self.wildcard: Set[T_Hook] = set()
+        self.by_field: Dict[str, Set[T_Hook]] = {}
+
+    def add(self, func: T_Hook, fields: Optional[Iterable[str]] = None):
+        self.callbacks.append(func)
+        if fields is None:
+            self.wildcard.add(func)
+        else:
+            for field in fields:
+                self.by_field.setdefault(field, set()).add(func)
+
+    @property
+    def fields(self) -> Optional[FrozenSet[str]]:
+        """ Fields watched by the callbacks, None if any callback watches every field. """
+        return frozenset(self.by_field) if not self.wildcard else None
+
+    def match(self, fields: Iterable[str]) -> List[T_Hook]:
+        hit = set(self.wildcard)
+        for field in fields:
+            hit.update(self.by_field.get(field, ()))
+        return [callback for callback in self.callbacks if callback in hit]
 
 
 class App:
@@ -27,11 +67,25 @@ class App:
         self._shutdown: List[T_Life] = []
         self._routes: List[Route] = []
         self._middleware: list = []
-        self._dispatchers: List[T_Dispatcher] = []
+        self._dispatchers: List[Dispatcher] = []
+        self._stats: Dict[str, T_Stats] = {"dispatchers": self._dispatch_stats}
         # storage related
-        self._on_update: Dict[str, List[Callable[[KVPair, dict, dict, dict], Awaitable[None]]]] = {}
-        self._on_create: Dict[str, List[Callable[[KVPair], Awaitable[None]]]] = {}
-        self._on_delete: Dict[str, List[Callable[[KVPair], Awaitable[None]]]] = {}
+        self._on_update: Dict[str, Hooks] = {}
+        self._on_create: Dict[str, Hooks] = {}
+        self._on_delete: Dict[str, Hooks] = {}
+        # latest hook task of each (storage, key), hooks of the same key run in order
+        self._hook_tails: Dict[Tuple[str, str], asyncio.Future] = {}
+        # seconds shutdown waits for pending hooks
+        self.hook_join_timeout: float = 10
+        self._hook_metrics: Dict[str, Dict[str, float]] = {}
+        self._stats["hooks"] = self._hook_stats
+
+        # event dispatch, must be configured before plugins are loaded
+        self.dispatch_queue_size: int = 256
+        self.dispatch_overflow: Overflow = Overflow.BLOCK
+        self.dedup: DedupIndex = DedupIndex()
+        self._stats["dedup"] = self.dedup.stats
+        self.outbox: Optional[Outbox] = None
 
         # job scheduler
         self.scheduler: AsyncIOScheduler = AsyncIOScheduler(event_loop=self.loop)
@@ -50,7 +104,9 @@ class App:
 
     def init_starlette(self, debug: bool = False):
         self._starlette = Starlette(debug=debug, routes=self._routes, middleware=self._middleware,
-                                    on_startup=self._startup, on_shutdown=self._shutdown)
+                                    on_startup=[self._start_dispatch, *self._startup],
+                                    on_shutdown=[*self._shutdown, self._join_hooks, self._stop_dispatch,
+                                                 self._flush_storages])
 
     @property
     def starlette(self) -> Starlette:
@@ -81,12 +137,59 @@ class App:
         return self._states
 
     async def send_event(self, event: Event):
+        if self.dedup.seen(event):
+            logging.debug(f"Duplicate event {event.identity}. Ignoring.")
+            return
+        if self.outbox:
+            self.outbox.append(event)
         for _dispatcher in self._dispatchers:
-            # noinspection PyBroadException
-            try:
-                await _dispatcher(event)
-            except Exception:
-                traceback.print_exc()
+            await _dispatcher.put(event)
+
+    async def send_events(self, events: Iterable[Event]):
+        events = [event for event in events if not self.dedup.seen(event)]
+        if not events:
+            return
+        if self.outbox:
+            for event in events:
+                self.outbox.append(event)
+        for _dispatcher in self._dispatchers:
+            await _dispatcher.put_many(events)
+
+    async def _load_dedup(self):
+        # noinspection PyTypeChecker
+        keys = [obj.key async for obj in self.plugin_state.iter([]) if obj.key.startswith(DEDUP_PREFIX)]
+        markers = await self.plugin_state.get_many(keys)
+        self.dedup.load((*key[len(DEDUP_PREFIX):].rsplit(":", 1), marker.value[EXPIRE_AT])
+                        for key, marker in markers.items())
+
+    async def _dump_dedup(self):
+        if self.dedup.dirty:
+            touched, evicted = self.dedup.changes()
+            await self.plugin_state.put_many(KVPair(f"{DEDUP_PREFIX}{event_type}:{h}", {EXPIRE_AT: deadline})
+                                             for event_type, h, deadline in touched)
+            await self.plugin_state.delete_many(KVPair(f"{DEDUP_PREFIX}{event_type}:{h}", {})
+                                                for event_type, h in evicted)
+
+    async def _start_dispatch(self):
+        await self._load_dedup()
+        self.scheduler.add_job(self._dump_dedup, "interval", minutes=1, misfire_grace_time=10)
+        for _dispatcher in self._dispatchers:
+            _dispatcher.start()
+
+    async def _stop_dispatch(self):
+        await asyncio.gather(*(_dispatcher.stop() for _dispatcher in self._dispatchers))
+        await self._dump_dedup()
+        if self.outbox:
+            self.outbox.close()
+
+    async def _flush_storages(self):
+        await asyncio.gather(*(storage.flush() for storage in [self._vtubers, self._configs, self._states] if storage))
+
+    def _dispatch_stats(self) -> dict:
+        return {_dispatcher.name: _dispatcher.stats() for _dispatcher in self._dispatchers}
+
+    def stats(self) -> Dict[str, dict]:
+        return {name: func() for name, func in self._stats.items()}
 
     def register_middleware(self, middleware: Middleware):
         if not isinstance(middleware, Middleware):
@@ -94,29 +197,85 @@ class App:
         self._middleware.append(middleware)
 
     # Storage events
-    async def hook_create(self, storage_name: str, obj: KVPair):
-        for callback in self._on_create.get(storage_name, []):
-            # noinspection PyBroadException
-            try:
-                await callback(obj)
-            except Exception:
-                traceback.print_exc()
-
-    async def hook_update(self, storage_name: str, obj: KVPair, added: dict, removed: dict, updated: dict):
-        for callback in self._on_update.get(storage_name, []):
-            # noinspection PyBroadException
-            try:
-                await callback(obj, added, removed, updated)
-            except Exception:
-                traceback.print_exc()
-
-    async def hook_delete(self, storage_name: str, obj: KVPair):
-        for callback in self._on_delete.get(storage_name, []):
-            # noinspection PyBroadException
-            try:
-                await callback(obj)
-            except Exception:
-                traceback.print_exc()
+    async def _run_hook(self, callback: T_Hook, *args):
+        name = f"{callback.__module__}.{callback.__qualname__}"
+        metrics = self._hook_metrics.setdefault(name, {"calls": 0, "failures": 0, "total_time": 0, "max_time": 0})
+        start = time.perf_counter()
+        # noinspection PyBroadException
+        try:
+            await callback(*args)
+        except Exception:
+            metrics["failures"] += 1
+            traceback.print_exc()
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics["calls"] += 1
+            metrics["total_time"] += elapsed
+            metrics["max_time"] = max(metrics["max_time"], elapsed)
+
+    def _schedule_hooks(self, storage_name: str, key: str, callbacks: List[T_Hook], *args) -> asyncio.Future:
+        """
+        Run callbacks concurrently, after the hooks previously scheduled for the same key have finished.
+
+        Hooks scheduled by a running hook for its own key, e.g. when it writes the document back, run right away
+        instead, as the running hook may be waiting for them.
+        The returned future completes when every callback has returned.
+        """
+        tail_key = (storage_name, key)
+        nested = _running_hooks.get() == tail_key
+        prev = self._hook_tails.get(tail_key) if not nested else None
+        if not callbacks and prev is None:
+            (done := self.loop.create_future()).set_result(None)
+            return done
+
+        async def run():
+            if prev is not None:
+                await asyncio.wait([prev])
+            _running_hooks.set(tail_key)
+            await asyncio.gather(*(self._run_hook(callback, *args) for callback in callbacks))
+
+        if nested:
+            return asyncio.ensure_future(run())
+
+        def cleanup(_task: asyncio.Future):
+            if self._hook_tails.get(tail_key) is _task:
+                self._hook_tails.pop(tail_key)
+
+        task = asyncio.ensure_future(run())
+        self._hook_tails[tail_key] = task
+        task.add_done_callback(cleanup)
+        return task
+
+    @staticmethod
+    def _match_hooks(hooks: Dict[str, Hooks], storage_name: str, fields: Iterable[str]) -> List[T_Hook]:
+        return _hooks.match(fields) if (_hooks := hooks.get(storage_name)) else []
+
+    def watched_fields(self, storage_name: str) -> Optional[FrozenSet[str]]:
+        """ Fields watched by update hooks of the storage, None if any hook watches every field. """
+        return hooks.fields if (hooks := self._on_update.get(storage_name)) else frozenset()
+
+    def hook_create(self, storage_name: str, obj: KVPair) -> asyncio.Future:
+        callbacks = self._match_hooks(self._on_create, storage_name, obj.value)
+        return self._schedule_hooks(storage_name, obj.key, callbacks, obj)
+
+    def hook_update(self, storage_name: str, obj: KVPair, added: dict, removed: dict,
+                    updated: dict) -> asyncio.Future:
+        callbacks = self._match_hooks(self._on_update, storage_name, [*added, *removed, *updated])
+        return self._schedule_hooks(storage_name, obj.key, callbacks, obj, added, removed, updated)
+
+    def hook_delete(self, storage_name: str, obj: KVPair) -> asyncio.Future:
+        callbacks = self._match_hooks(self._on_delete, storage_name, obj.value)
+        return self._schedule_hooks(storage_name, obj.key, callbacks, obj)
+
+    async def _join_hooks(self):
+        if self._hook_tails:
+            _, pending = await asyncio.wait(list(self._hook_tails.values()), timeout=self.hook_join_timeout)
+            if pending:
+                keys = [f"{storage}/{key}" for (storage, key), task in self._hook_tails.items() if task in pending]
+                logging.warning(f"Shutting down with hooks still running for {', '.join(keys)}.")
+
+    def _hook_stats(self) -> dict:
+        return {"pending_keys": len(self._hook_tails), "callbacks": self._hook_metrics}
 
     # Plugin decorators
     def on_startup(self, func: T_Life):
@@ -149,30 +308,44 @@ class App:
         return wrapper
 
     def dispatcher(self, func: T_Dispatcher):
-        self._dispatchers.append(func)
+        self._dispatchers.append(Dispatcher(func, self.dispatch_queue_size, self.dispatch_overflow))
         return func
 
-    def on_update(self, storage_name: str):
+    def batch_dispatcher(self, func: T_BatchDispatcher):
+        self._dispatchers.append(Dispatcher(func, self.dispatch_queue_size, self.dispatch_overflow, batch=True))
+        return func
+
+    def stats_provider(self, name: str):
+        def wrapper(func: T_Stats):
+            self._stats[name] = func
+            return func
+
+        return wrapper
+
+    def on_update(self, storage_name: str, fields: Optional[Iterable[str]] = None):
         def wrapper(func):
             if self._on_update.get(storage_name) is None:
-                self._on_update[storage_name] = []
-            self._on_update[storage_name].append(func)
+                self._on_update[storage_name] = Hooks()
+            self._on_update[storage_name].add(func, fields)
+            return func
 
         return wrapper
 
-    def on_create(self, storage_name: str):
+    def on_create(self, storage_name: str, fields: Optional[Iterable[str]] = None):
         def wrapper(func):
             if self._on_create.get(storage_name) is None:
-                self._on_create[storage_name] = []
-            self._on_create[storage_name].append(func)
+                self._on_create[storage_name] = Hooks()
+            self._on_create[storage_name].add(func, fields)
+            return func
 
         return wrapper
 
-    def on_delete(self, storage_name: str):
+    def on_delete(self, storage_name: str, fields: Optional[Iterable[str]] = None):
         def wrapper(func):
             if self._on_delete.get(storage_name) is None:
-                self._on_delete[storage_name] = []
-            self._on_delete[storage_name].append(func)
+                self._on_delete[storage_name] = Hooks()
+            self._on_delete[storage_name].add(func, fields)
+            return func
 
         return wrapper
 
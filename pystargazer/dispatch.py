@@ -0,0 +1,196 @@
+import asyncio
+import logging
+import time
+import traceback
+from collections import OrderedDict
+from enum import Enum
+from hashlib import blake2b
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from .models import Event
+
+T_Dispatcher = Callable[[Event], Awaitable[None]]
+T_BatchDispatcher = Callable[[List[Event]], Awaitable[None]]
+
+
+class Overflow(Enum):
+    BLOCK = "block"
+    DROP_OLDEST = "drop_oldest"
+    DROP_NEWEST = "drop_newest"
+
+
+class DedupIndex:
+    """
+    Bounded LRU indexes of recently dispatched event identities, one per event type.
+
+    Each type has its own capacity, so that frequent types such as tweets don't evict the others.
+    Identities are stored as short hashes with an expiry deadline, and the entries changed since the last call to
+    changes are tracked, so the index can be persisted incrementally.
+    """
+
+    def __init__(self, maxsize: int = 8192, ttl: float = 30 * 86400):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # event type -> hash -> deadline
+        self._indexes: Dict[str, "OrderedDict[str, float]"] = {}
+        self._touched: Set[Tuple[str, str]] = set()
+        self._evicted: Set[Tuple[str, str]] = set()
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._touched or self._evicted)
+
+    @staticmethod
+    def _hash(identity: str) -> str:
+        return blake2b(identity.encode("utf-8"), digest_size=8).hexdigest()
+
+    def _expire(self, event_type: str, now: float):
+        index = self._indexes[event_type]
+        while index and (len(index) > self.maxsize or next(iter(index.values())) <= now):
+            h, _ = index.popitem(last=False)
+            self._touched.discard((event_type, h))
+            self._evicted.add((event_type, h))
+
+    def seen(self, event: Event) -> bool:
+        """ Check whether the event has been dispatched before, and remember it. """
+        if (identity := event.identity) is None:
+            return False
+
+        now = time.time()
+        h = self._hash(identity)
+        index = self._indexes.setdefault(event.type, OrderedDict())
+        hit = index.get(h, 0) > now
+        index[h] = now + self.ttl
+        index.move_to_end(h)
+        self._touched.add((event.type, h))
+        self._evicted.discard((event.type, h))
+        self._expire(event.type, now)
+
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return hit
+
+    def load(self, entries: Iterable[Tuple[str, str, float]]):
+        """ Restore (event type, hash, deadline) entries. """
+        for event_type, h, deadline in sorted(entries, key=lambda entry: entry[2]):
+            self._indexes.setdefault(event_type, OrderedDict())[h] = deadline
+        now = time.time()
+        for event_type in self._indexes:
+            self._expire(event_type, now)
+        self._touched.clear()
+
+    def changes(self) -> Tuple[List[Tuple[str, str, float]], List[Tuple[str, str]]]:
+        """ Entries remembered and (event type, hash) of those evicted since the last call. """
+        touched = [(event_type, h, self._indexes[event_type][h]) for event_type, h in self._touched]
+        evicted = list(self._evicted)
+        self._touched.clear()
+        self._evicted.clear()
+        return touched, evicted
+
+    def stats(self) -> dict:
+        return {
+            "size": {event_type: len(index) for event_type, index in self._indexes.items()},
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+class Dispatcher:
+    """
+    A dispatcher fed by its own bounded queue and drained by its own worker task.
+
+    Batch dispatchers receive every event already queued (up to max_batch) in a single call.
+    """
+
+    def __init__(self, func: Union[T_Dispatcher, T_BatchDispatcher], maxsize: int = 0,
+                 overflow: Overflow = Overflow.BLOCK, batch: bool = False, max_batch: int = 256):
+        self.func = func
+        self.name = f"{func.__module__}.{func.__qualname__}"
+        self.overflow = overflow
+        self.batch = batch
+        self.max_batch = max_batch
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.task: Optional[asyncio.Task] = None
+
+        # counters
+        self.enqueued = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.failed = 0
+        self.peak_depth = 0
+
+    async def put(self, event: Event):
+        if self.overflow == Overflow.BLOCK:
+            await self.queue.put(event)
+        elif self.queue.full() and self.overflow == Overflow.DROP_NEWEST:
+            self.dropped += 1
+            return
+        else:
+            while self.queue.full():
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self.dropped += 1
+            self.queue.put_nowait(event)
+
+        self.enqueued += 1
+        self.peak_depth = max(self.peak_depth, self.queue.qsize())
+
+    async def put_many(self, events: Iterable[Event]):
+        for event in events:
+            await self.put(event)
+
+    async def _deliver(self, events: List[Event]):
+        # noinspection PyBroadException
+        try:
+            if self.batch:
+                await self.func(events)
+            else:
+                for event in events:
+                    await self.func(event)
+            self.delivered += len(events)
+        except Exception:
+            self.failed += len(events)
+            traceback.print_exc()
+
+    async def _run(self):
+        while True:
+            events = [await self.queue.get()]
+            if self.batch:
+                while len(events) < self.max_batch and not self.queue.empty():
+                    events.append(self.queue.get_nowait())
+            try:
+                await self._deliver(events)
+            finally:
+                for _ in events:
+                    self.queue.task_done()
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._run())
+
+    async def stop(self, timeout: float = 5):
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Dispatcher {self.name} stopped with {self.queue.qsize()} pending event(s).")
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.queue.qsize(),
+            "peak_depth": self.peak_depth,
+            "maxsize": self.queue.maxsize,
+            "enqueued": self.enqueued,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "failed": self.failed
+        }
@@ -1,27 +1,154 @@
+import asyncio
 import importlib
 import json
+import logging
 import os
+import time
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
-from typing import Any, AsyncGenerator, Dict, Optional, Tuple
+from collections import OrderedDict
+from copy import deepcopy
+from dataclasses import dataclass, field as dc_field
+from typing import Any, AsyncGenerator, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 from urllib.parse import urlparse
 
-from .utils import compare_dict
+from .utils import compare_dict, dump_json, load_json
 
 
 @dataclass
 class Event:
-    __slots__ = ["type", "vtuber", "data"]
     type: str
     vtuber: str
     data: dict
+    # stable source id used for deduplication, falls back to data["link"]
+    id: Optional[str] = None
+    # sequence number assigned by the outbox
+    seq: Optional[int] = None
+    # encoded payload shared by every sink, computed on first access
+    _encoded: Optional[bytes] = dc_field(default=None, init=False, repr=False, compare=False)
+    _text: Optional[str] = dc_field(default=None, init=False, repr=False, compare=False)
+
+    @classmethod
+    def load(cls, payload: bytes):
+        json_dict = load_json(payload)
+        event = cls(json_dict["type"], json_dict["vtuber"], json_dict["data"], seq=json_dict.get("seq"))
+        event._encoded = payload
+        return event
+
+    @property
+    def encoded(self) -> bytes:
+        """ JSON encoded event. The event must not be modified once this has been accessed. """
+        if self._encoded is None:
+            self._encoded = dump_json(self.to_json())
+        return self._encoded
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self.encoded.decode("utf-8")
+        return self._text
+
+    @property
+    def identity(self) -> Optional[str]:
+        if (source := self.id if self.id is not None else self.data.get("link")) is None:
+            return None
+        return f"{self.type}:{self.vtuber}:{source}"
 
     def to_json(self):
-        return {
+        json_dict = {
             "type": self.type,
             "vtuber": self.vtuber,
             "data": self.data,
         }
+        if self.seq is not None:
+            json_dict["seq"] = self.seq
+        return json_dict
+
+
+_MISSING = object()
+
+
+class TrackedDict(dict):
+    """ A dict recording the original value of every top-level field mutated since the last commit. """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.original: Dict[str, Any] = {}
+
+    def __reduce__(self):
+        return self.__class__, (dict(self),)
+
+    def _touch(self, key: str):
+        if key not in self.original:
+            self.original[key] = super().get(key, _MISSING)
+
+    def __setitem__(self, key: str, value: Any):
+        self._touch(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key: str):
+        self._touch(key)
+        super().__delitem__(key)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def pop(self, key: str, *args):
+        if key in self:
+            self._touch(key)
+        return super().pop(key, *args)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self.original.setdefault(key, value)
+        return key, value
+
+    def setdefault(self, key: str, default: Any = None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        for key in list(self):
+            del self[key]
+
+    def delta(self) -> Tuple[dict, dict, dict]:
+        """ Added, removed and updated fields since the last commit, in the format of compare_dict. """
+        added, removed, updated = {}, {}, {}
+        for key, old in self.original.items():
+            new = super().get(key, _MISSING)
+            if old is _MISSING and new is not _MISSING:
+                added[key] = new
+            elif old is not _MISSING and new is _MISSING:
+                removed[key] = old
+            elif old is not _MISSING and old != new:
+                updated[key] = (old, new)
+        return added, removed, updated
+
+    def snapshot(self) -> dict:
+        """ A shallow copy of the dict as it was at the last commit. """
+        old = dict(self)
+        for key, value in self.original.items():
+            if value is _MISSING:
+                old.pop(key, None)
+            else:
+                old[key] = value
+        return old
+
+    def commit(self):
+        self.original.clear()
+
+
+# field holding the unix time after which the storage drops the document
+EXPIRE_AT = "_expire_at"
+
+
+def expired(value: Dict[str, Any], now: Optional[float] = None) -> bool:
+    return EXPIRE_AT in value and value[EXPIRE_AT] <= (now if now is not None else time.time())
 
 
 @dataclass
@@ -41,14 +168,54 @@ class KVPair:
     def dump(self):
         return {"key": self.key, **self.value}
 
+    def track(self):
+        """
+        Record mutations of top-level fields from now on, so that a put only writes the changed fields.
+
+        In-place changes of nested values are not recorded, reassign the field instead.
+        """
+        if not isinstance(self.value, TrackedDict):
+            self.value = TrackedDict(self.value)
+        return self
+
+    def expire_in(self, seconds: float):
+        """ Let the storage drop the document once seconds have passed. """
+        self.value[EXPIRE_AT] = time.time() + seconds
+        return self
+
+    @property
+    def ttl(self) -> Optional[float]:
+        """ Seconds left before the document expires, None if it never does. """
+        return self.value[EXPIRE_AT] - time.time() if EXPIRE_AT in self.value else None
+
+    def project(self, fields: Optional[Iterable[str]]):
+        """ Keep only the given fields, or all of them if fields is None. """
+        if fields is not None:
+            self.value = {field: self.value[field] for field in fields if field in self.value}
+        return self
+
 
 class AbstractKVContainer(ABC):
+    """
+    Storage of the documents of a table.
+
+    Documents having an EXPIRE_AT field are dropped by the storage once that time has passed, backends without a
+    precise timer may still return them for about a minute.
+    """
+
     @abstractmethod
     async def get(self, key: str) -> KVPair:
         return NotImplemented
 
     @abstractmethod
-    async def has_field(self, field: str) -> AsyncGenerator[KVPair, None]:
+    async def has_field(self, field: str, projection: Optional[List[str]] = None, batch_size: int = 256,
+                        after: Optional[str] = None) -> AsyncGenerator[KVPair, None]:
+        """
+        Yield the documents having the field in key order, starting after the key given as cursor.
+
+        projection limits the yielded fields, an empty projection yields keys only.
+        Documents are fetched batch_size at a time.
+        """
         return NotImplemented
 
     @abstractmethod
@@ -56,13 +223,393 @@ class AbstractKVContainer(ABC):
         return NotImplemented
 
     @abstractmethod
-    async def iter(self) -> AsyncGenerator[KVPair, None]:
+    async def iter(self, projection: Optional[List[str]] = None, batch_size: int = 256,
+                   after: Optional[str] = None) -> AsyncGenerator[KVPair, None]:
+        """ Yield every document in key order, see has_field. """
         return NotImplemented
 
     @abstractmethod
     async def delete(self, obj: KVPair) -> KVPair:
         return NotImplemented
 
+    async def create_index(self, field: str):
+        """ Index documents having the field, so that has_field doesn't scan the table. """
+
+    async def flush(self):
+        """ Wait until every write made so far has reached the backing store. """
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, KVPair]:
+        """ Get several documents at once. Missing keys are left out of the result. """
+        return {key: obj for key in keys if (obj := await self.get(key)) is not None}
+
+    async def put_many(self, objs: Iterable[KVPair]) -> List[Tuple[Optional[KVPair], KVPair]]:
+        return [await self.put(obj) for obj in objs]
+
+    async def delete_many(self, objs: Iterable[KVPair]) -> List[KVPair]:
+        """ Delete several documents at once. Return the deleted documents, missing ones are ignored. """
+        existing = await self.get_many(obj.key for obj in objs)
+        return [await self.delete(obj) for obj in existing.values()]
+
+    async def update(self, key: str, set_fields: Dict[str, Any], unset_fields: Iterable[str]) -> bool:
+        """ Patch top-level fields of an existing document. Return False if the document doesn't exist. """
+        if (obj := await self.get(key)) is None:
+            return False
+        obj.value.update(set_fields)
+        for field in unset_fields:
+            obj.value.pop(field, None)
+        await self.put(obj)
+        return True
+
+
+class CachedKVContainer(AbstractKVContainer):
+    """
+    Write-through in-memory cache in front of another container, evicting the least recently used documents.
+
+    The first has_field or iter loads the whole table, and as long as it fits, scans and lookups of missing keys
+    are served from memory as well. The cache assumes it is the only writer of the underlying storage.
+    """
+
+    def __init__(self, container: AbstractKVContainer, maxsize: int = 1024):
+        self.container = container
+        self.maxsize = maxsize
+        self._docs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        # whether _docs holds every document of the table
+        self.complete = False
+        # whether the table was found larger than maxsize, so that it isn't loaded again on every scan
+        self._oversized = False
+        self._evictions = 0
+        # keys written while the table is being loaded, whose loaded documents may be outdated
+        self._filling: Optional[Set[str]] = None
+        self._fill_lock = asyncio.Lock()
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, key: str, value: Dict[str, Any]):
+        self._docs[key] = deepcopy(dict(value))
+        self._docs.move_to_end(key)
+        while len(self._docs) > self.maxsize:
+            self._docs.popitem(last=False)
+            self._evictions += 1
+            self.complete = False
+
+    def _load(self, key: str) -> KVPair:
+        return KVPair(key, deepcopy(self._docs[key]))
+
+    def _written(self, keys: Iterable[str]):
+        if self._filling is not None:
+            self._filling.update(keys)
+
+    async def _fill(self) -> bool:
+        """ Load the whole table unless it is known not to fit, return whether the cache holds all of it. """
+        if self.complete or self._oversized:
+            return self.complete
+        async with self._fill_lock:
+            if not (self.complete or self._oversized):
+                self.misses += 1
+                evictions = self._evictions
+                self._filling = set()
+                try:
+                    # noinspection PyTypeChecker
+                    async for obj in self.container.iter():
+                        if obj.key not in self._filling:
+                            self._store(obj.key, obj.value)
+                    # read the documents written meanwhile again
+                    while self._filling:
+                        keys, self._filling = self._filling, set()
+                        for key, obj in (await self.container.get_many(keys)).items():
+                            if key not in self._filling:
+                                self._store(key, obj.value)
+                finally:
+                    self._filling = None
+                self.complete = self._evictions == evictions
+                self._oversized = not self.complete
+        return self.complete
+
+    def _cached(self, key: str) -> bool:
+        # expired documents are dropped by the underlying storage behind the back of the cache
+        if (value := self._docs.get(key)) is not None and expired(value):
+            self._docs.pop(key)
+        return key in self._docs
+
+    async def get(self, key: str) -> Optional[KVPair]:
+        if self._cached(key):
+            self.hits += 1
+            self._docs.move_to_end(key)
+            return self._load(key)
+        if self.complete:
+            self.hits += 1
+            return None
+
+        self.misses += 1
+        if (obj := await self.container.get(key)) is not None:
+            self._store(key, obj.value)
+        return obj
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, KVPair]:
+        keys = list(keys)
+        objs = {key: self._load(key) for key in keys if self._cached(key)}
+        self.hits += len(objs)
+        if missing := [key for key in keys if key not in objs]:
+            if self.complete:
+                self.hits += len(missing)
+            else:
+                self.misses += len(missing)
+                for key, obj in (await self.container.get_many(missing)).items():
+                    self._store(key, obj.value)
+                    objs[key] = obj
+        return objs
+
+    def _scan(self, keys: Iterable[str], projection: Optional[List[str]], after: Optional[str]) -> Iterator[KVPair]:
+        for key in sorted(key for key in keys if after is None or key > after):
+            if self._cached(key):
+                yield self._load(key).project(projection)
+
+    async def has_field(self, field: str, projection: Optional[List[str]] = None, batch_size: int = 256,
+                        after: Optional[str] = None) -> AsyncGenerator[KVPair, None]:
+        if await self._fill():
+            self.hits += 1
+            for obj in self._scan([key for key, value in self._docs.items() if field in value], projection, after):
+                yield obj
+            return
+
+        self.misses += 1
+        # noinspection PyTypeChecker
+        async for obj in self.container.has_field(field, projection, batch_size, after):
+            yield obj
+
+    async def put(self, obj: KVPair) -> Tuple[Optional[KVPair], KVPair]:
+        old_obj, new_obj = await self.container.put(obj)
+        self._written([obj.key])
+        self._store(obj.key, obj.value)
+        return old_obj, new_obj
+
+    async def put_many(self, objs: Iterable[KVPair]) -> List[Tuple[Optional[KVPair], KVPair]]:
+        results = await self.container.put_many(objs)
+        self._written(obj.key for _, obj in results)
+        for _, obj in results:
+            self._store(obj.key, obj.value)
+        return results
+
+    async def update(self, key: str, set_fields: Dict[str, Any], unset_fields: Iterable[str]) -> bool:
+        self._written([key])
+        if not (result := await self.container.update(key, set_fields, unset_fields)):
+            self._docs.pop(key, None)
+        elif (value := self._docs.get(key)) is not None:
+            value.update(deepcopy(set_fields))
+            for field in unset_fields:
+                value.pop(field, None)
+        return result
+
+    async def iter(self, projection: Optional[List[str]] = None, batch_size: int = 256,
+                   after: Optional[str] = None) -> AsyncGenerator[KVPair, None]:
+        if await self._fill():
+            self.hits += 1
+            for obj in self._scan(list(self._docs), projection, after):
+                yield obj
+            return
+
+        self.misses += 1
+        # noinspection PyTypeChecker
+        async for obj in self.container.iter(projection, batch_size, after):
+            yield obj
+
+    async def delete(self, obj: KVPair) -> KVPair:
+        self._written([obj.key])
+        obj = await self.container.delete(obj)
+        self._docs.pop(obj.key, None)
+        # the table may fit again
+        self._oversized = False
+        return obj
+
+    async def delete_many(self, objs: Iterable[KVPair]) -> List[KVPair]:
+        objs = list(objs)
+        self._written(obj.key for obj in objs)
+        deleted = await self.container.delete_many(objs)
+        for obj in objs:
+            self._docs.pop(obj.key, None)
+        self._oversized = False
+        return deleted
+
+    async def create_index(self, field: str):
+        await self.container.create_index(field)
+
+    async def flush(self):
+        await self.container.flush()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._docs),
+            "maxsize": self.maxsize,
+            "complete": self.complete,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+class WriteBehindKVContainer(AbstractKVContainer):
+    """
+    Buffer writes in front of another container and write them back in batches.
+
+    A batch is written once no write has come for window seconds, or max_staleness seconds after its first write,
+    so that several puts of the same key collapse into a single backend write. A failed batch is retried with
+    exponential backoff, up to max_staleness seconds apart.
+    get and get_many see the buffered writes, deletes drop them, other operations write the buffer back before
+    running.
+    """
+
+    def __init__(self, container: AbstractKVContainer, window: float = 5, max_staleness: float = 60):
+        self.container = container
+        self.window = window
+        self.max_staleness = max_staleness
+        # key -> buffered document, and those being written back
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._inflight: Dict[str, Dict[str, Any]] = {}
+        self._lock = asyncio.Lock()
+        self._first_write: Optional[float] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # seconds before retrying a failed batch, 0 unless the last write back failed
+        self._backoff: float = 0
+
+        # counters
+        self.writes = 0
+        self.flushed = 0
+        self.failures = 0
+
+    def _buffered(self, key: str) -> Optional[Dict[str, Any]]:
+        return self._pending.get(key, self._inflight.get(key))
+
+    def _buffer(self, key: str, value: Dict[str, Any]):
+        self._pending[key] = deepcopy(dict(value))
+        self.writes += 1
+
+        loop = asyncio.get_event_loop()
+        if self._first_write is None:
+            self._first_write = loop.time()
+        if self._backoff:
+            # written with the pending retry
+            return
+        deadline = min(loop.time() + self.window, self._first_write + self.max_staleness)
+        self._arm(deadline)
+
+    def _arm(self, deadline: float):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_event_loop().call_at(deadline, lambda: asyncio.ensure_future(self._write_back()))
+
+    async def _write_back(self):
+        async with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            first_write, self._first_write = self._first_write, None
+            if not self._pending:
+                return
+
+            self._inflight, self._pending = self._pending, {}
+            # noinspection PyBroadException
+            try:
+                await self.container.put_many(KVPair(key, value) for key, value in self._inflight.items())
+                self.flushed += len(self._inflight)
+                if self._backoff and self._pending:
+                    # buffered while retrying, without a timer of their own
+                    self._arm(min(asyncio.get_event_loop().time() + self.window,
+                                  self._first_write + self.max_staleness))
+                self._backoff = 0
+            except Exception:
+                self.failures += 1
+                self._backoff = min(max(self._backoff * 2, 1), self.max_staleness)
+                logging.exception(f"Failed to write back buffered documents, retrying in {self._backoff} seconds.")
+                for key, value in self._inflight.items():
+                    self._pending.setdefault(key, value)
+                # the batch stays as old as its first write
+                self._first_write = first_write
+                self._arm(asyncio.get_event_loop().time() + self._backoff)
+            finally:
+                self._inflight = {}
+
+    async def flush(self):
+        await self._write_back()
+        await self.container.flush()
+
+    async def get(self, key: str) -> Optional[KVPair]:
+        if (value := self._buffered(key)) is not None:
+            return KVPair(key, deepcopy(value))
+        return await self.container.get(key)
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, KVPair]:
+        keys = list(keys)
+        objs = {key: KVPair(key, deepcopy(value)) for key in keys if (value := self._buffered(key)) is not None}
+        if missing := [key for key in keys if key not in objs]:
+            objs.update(await self.container.get_many(missing))
+        return objs
+
+    async def has_field(self, field: str, projection: Optional[List[str]] = None, batch_size: int = 256,
+                        after: Optional[str] = None) -> AsyncGenerator[KVPair, None]:
+        await self._write_back()
+        # noinspection PyTypeChecker
+        async for obj in self.container.has_field(field, projection, batch_size, after):
+            yield obj
+
+    async def put(self, obj: KVPair) -> Tuple[Optional[KVPair], KVPair]:
+        old_obj = await self.get(obj.key)
+        self._buffer(obj.key, obj.value)
+        return old_obj, obj
+
+    async def put_many(self, objs: Iterable[KVPair]) -> List[Tuple[Optional[KVPair], KVPair]]:
+        objs = list(objs)
+        old_objs = await self.get_many({obj.key for obj in objs})
+        results = []
+        for obj in objs:
+            results.append((old_objs.get(obj.key), obj))
+            old_objs[obj.key] = obj
+            self._buffer(obj.key, obj.value)
+        return results
+
+    async def update(self, key: str, set_fields: Dict[str, Any], unset_fields: Iterable[str]) -> bool:
+        if (obj := await self.get(key)) is None:
+            return False
+        obj.value.update(set_fields)
+        for field in unset_fields:
+            obj.value.pop(field, None)
+        self._buffer(key, obj.value)
+        return True
+
+    async def iter(self, projection: Optional[List[str]] = None, batch_size: int = 256,
+                   after: Optional[str] = None) -> AsyncGenerator[KVPair, None]:
+        await self._write_back()
+        # noinspection PyTypeChecker
+        async for obj in self.container.iter(projection, batch_size, after):
+            yield obj
+
+    async def delete(self, obj: KVPair) -> KVPair:
+        # wait for the batch being written back, so that a failed one can't bring the key back
+        async with self._lock:
+            if (value := self._pending.pop(obj.key, None)) is None:
+                return await self.container.delete(obj)
+            if await self.container.get(obj.key) is not None:
+                await self.container.delete(obj)
+            return KVPair(obj.key, value)
+
+    async def delete_many(self, objs: Iterable[KVPair]) -> List[KVPair]:
+        objs = list(objs)
+        async with self._lock:
+            buffered = [KVPair(obj.key, value) for obj in objs if (value := self._pending.pop(obj.key, None))]
+            keys = {obj.key for obj in buffered}
+            return [*buffered, *(obj for obj in await self.container.delete_many(objs) if obj.key not in keys)]
+
+    async def create_index(self, field: str):
+        await self.container.create_index(field)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "writes": self.writes,
+            "flushed": self.flushed,
+            "failures": self.failures
+        }
+
 
 class Credential:
     def __init__(self, fn):
@@ -110,36 +657,159 @@ class KVContainer:
             storages[scheme] = container
             return container(url)
 
-    def __init__(self, url, container_name):
+    def __init__(self, url, container_name, cache_size: int = 0, write_behind: float = 0, max_staleness: float = 60):
         self.name = container_name
         self.container: AbstractKVContainer = self._get_kv_container(url)
+        if cache_size > 0:
+            self.container = CachedKVContainer(self.container, cache_size)
+            app.app.stats_provider(f"{container_name}_cache")(self.container.stats)
+        if write_behind > 0:
+            self.container = WriteBehindKVContainer(self.container, write_behind, max_staleness)
+            app.app.stats_provider(f"{container_name}_write_behind")(self.container.stats)
+        # field -> str(value) -> key, built on first use of the field
+        self._reverse: Dict[str, Dict[str, str]] = {}
+        self._reverse_lock = asyncio.Lock()
+
+    async def _build_reverse(self, field: str):
+        index: Dict[str, str] = {}
+
+        def add(obj: KVPair, value: Any):
+            index[str(value)] = obj.key
+
+        def remove(obj: KVPair, value: Any):
+            if index.get(str(value)) == obj.key:
+                index.pop(str(value))
+
+        # keep the index consistent through storage hooks
+        async def on_create(obj: KVPair):
+            add(obj, obj.value[field])
+
+        async def on_update(obj: KVPair, added: dict, removed: dict, updated: dict):
+            if field in removed:
+                remove(obj, removed[field])
+            if field in updated:
+                remove(obj, updated[field][0])
+                add(obj, updated[field][1])
+            if field in added:
+                add(obj, added[field])
+
+        async def on_delete(obj: KVPair):
+            remove(obj, obj.value[field])
+
+        app.app.on_create(self.name, fields=[field])(on_create)
+        app.app.on_update(self.name, fields=[field])(on_update)
+        app.app.on_delete(self.name, fields=[field])(on_delete)
 
-    async def get(self, key: str) -> KVPair:
+        # noinspection PyTypeChecker
+        async for obj in self.has_field(field, [field]):
+            add(obj, obj.value[field])
+        self._reverse[field] = index
+
+    async def get(self, key: str, track: bool = False) -> KVPair:
+        """ Get a document. A tracked document only writes back its mutated top-level fields when put. """
         if (rtn := await self.container.get(key)) is None:
             raise KeyError
-        return rtn
+        return rtn.track() if track else rtn
+
+    async def get_many(self, keys: Iterable[str], track: bool = False) -> Dict[str, KVPair]:
+        """ Get several documents at once. Missing keys are left out of the result. """
+        objs = await self.container.get_many(keys)
+        return {key: obj.track() for key, obj in objs.items()} if track else objs
+
+    def has_field(self, field: str, projection: Optional[List[str]] = None, batch_size: int = 256,
+                  after: Optional[str] = None) -> AsyncGenerator[KVPair, None]:
+        """
+        Yield the documents having the field in key order, starting after the key given as cursor.
 
-    def has_field(self, field: str) -> AsyncGenerator[KVPair, None]:
+        projection limits the yielded fields, an empty projection yields keys only.
+        """
         # noinspection PyTypeChecker
-        return self.container.has_field(field)
+        return self.container.has_field(field, projection, batch_size, after)
+
+    async def create_index(self, field: str):
+        await self.container.create_index(field)
+
+    async def flush(self):
+        await self.container.flush()
+
+    async def find_by(self, field: str, value: Any) -> KVPair:
+        """ Get the document whose field equals value, compared as strings. """
+        if field not in self._reverse:
+            async with self._reverse_lock:
+                if field not in self._reverse:
+                    await self._build_reverse(field)
+        if (key := self._reverse[field].get(str(value))) is None:
+            raise KeyError
+        return await self.get(key)
 
     async def put(self, obj: KVPair) -> Tuple[Optional[KVPair], KVPair]:
+        old_obj, new_obj, hooks = await self.put_detached(obj)
+        await hooks
+        return old_obj, new_obj
+
+    async def put_detached(self, obj: KVPair) -> Tuple[Optional[KVPair], KVPair, asyncio.Future]:
+        """ Put without waiting for the hooks, which complete with the returned future. """
+        if isinstance(tracked := obj.value, TrackedDict):
+            # only write the fields mutated since the object was read
+            added, removed, updated = tracked.delta()
+            set_fields = {**added, **{key: new for key, (_, new) in updated.items()}}
+            if not (set_fields or removed) or await self.container.update(obj.key, set_fields, removed):
+                old_obj = KVPair(obj.key, tracked.snapshot())
+                tracked.commit()
+                return old_obj, obj, app.app.hook_update(self.name, obj, added, removed, updated)
+
         old_obj, new_obj = await self.container.put(obj)
+        return old_obj, new_obj, self._hook_put(old_obj, new_obj)
+
+    def _hook_put(self, old_obj: Optional[KVPair], new_obj: KVPair) -> asyncio.Future:
+        if isinstance(new_obj.value, TrackedDict):
+            new_obj.value.commit()
         if old_obj:
-            added, removed, updated = compare_dict(old_obj.value, new_obj.value)
-            await app.app.hook_update(self.name, new_obj, added, removed, updated)
+            if (fields := app.app.watched_fields(self.name)) is None or fields:
+                added, removed, updated = compare_dict(old_obj.value, new_obj.value, fields)
+            else:
+                # nobody listens, skip the diff
+                added, removed, updated = {}, {}, {}
+            return app.app.hook_update(self.name, new_obj, added, removed, updated)
         else:
-            await app.app.hook_create(self.name, new_obj)
-        return old_obj, new_obj
-
-    def iter(self) -> AsyncGenerator[KVPair, None]:
+            return app.app.hook_create(self.name, new_obj)
+
+    async def put_many(self, objs: Iterable[KVPair]) -> List[Tuple[Optional[KVPair], KVPair]]:
+        results, hooks = await self.put_many_detached(objs)
+        await hooks
+        return results
+
+    async def put_many_detached(self, objs: Iterable[KVPair]) \
+            -> Tuple[List[Tuple[Optional[KVPair], KVPair]], asyncio.Future]:
+        """ Write several documents in one backend operation, the hooks complete with the returned future. """
+        results = await self.container.put_many(objs)
+        return results, asyncio.gather(*(self._hook_put(old_obj, new_obj) for old_obj, new_obj in results))
+
+    def iter(self, projection: Optional[List[str]] = None, batch_size: int = 256,
+             after: Optional[str] = None) -> AsyncGenerator[KVPair, None]:
+        """ Yield every document in key order, see has_field. """
         # noinspection PyTypeChecker
-        return self.container.iter()
+        return self.container.iter(projection, batch_size, after)
 
     async def delete(self, obj: KVPair) -> KVPair:
-        obj = await self.container.delete(obj)
-        await app.app.hook_delete(self.name, obj)
+        obj, hooks = await self.delete_detached(obj)
+        await hooks
         return obj
 
+    async def delete_detached(self, obj: KVPair) -> Tuple[KVPair, asyncio.Future]:
+        """ Delete without waiting for the hooks, which complete with the returned future. """
+        obj = await self.container.delete(obj)
+        return obj, app.app.hook_delete(self.name, obj)
+
+    async def delete_many(self, objs: Iterable[KVPair]) -> List[KVPair]:
+        objs, hooks = await self.delete_many_detached(objs)
+        await hooks
+        return objs
+
+    async def delete_many_detached(self, objs: Iterable[KVPair]) -> Tuple[List[KVPair], asyncio.Future]:
+        """ Delete several documents in one backend operation, the hooks complete with the returned future. """
+        objs = await self.container.delete_many(objs)
+        return objs, asyncio.gather(*(app.app.hook_delete(self.name, obj) for obj in objs))
+
 
 import pystargazer.app as app
@@ -0,0 +1,108 @@
+import logging
+import os
+import time
+from typing import BinaryIO, Iterator, List, Optional
+
+from .models import Event
+from .utils import load_json
+
+
+class Outbox:
+    """
+    Append-only event log split into segment files.
+
+    Every appended event is assigned a monotonically increasing sequence number, and segments are named after the
+    first sequence number they hold so a replay can seek to the right file directly.
+    Old segments are removed once the log exceeds max_bytes or they are older than max_age seconds.
+    """
+
+    def __init__(self, directory: str, segment_size: int = 4 << 20, max_bytes: int = 256 << 20,
+                 max_age: float = 7 * 86400):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        self.last_seq = 0
+        self._segment: Optional[BinaryIO] = None
+
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+
+    @staticmethod
+    def _segment_name(first_seq: int) -> str:
+        return f"{first_seq:020d}.log"
+
+    def _segments(self) -> List[int]:
+        return sorted(int(fn[:-4]) for fn in os.listdir(self.directory) if fn.endswith(".log") and fn[:-4].isdigit())
+
+    def _path(self, first_seq: int) -> str:
+        return os.path.join(self.directory, self._segment_name(first_seq))
+
+    def _recover(self):
+        if not (segments := self._segments()):
+            return
+
+        path = self._path(segments[-1])
+        with open(path, mode="r+b") as f:
+            data = f.read()
+            # drop a record torn by a crash
+            if data and not data.endswith(b"\n"):
+                logging.warning(f"Truncating torn record in outbox segment {path}.")
+                data = data[:data.rfind(b"\n") + 1]
+                f.truncate(len(data))
+
+        self.last_seq = segments[-1] - 1
+        for line in data.splitlines():
+            self.last_seq = load_json(line)["seq"]
+        self._segment = open(path, mode="ab")
+
+    def _roll(self):
+        if self._segment is not None:
+            self._segment.close()
+        self._segment = open(self._path(self.last_seq + 1), mode="ab")
+        self._retain()
+
+    def _retain(self):
+        segments = self._segments()[:-1]  # never remove the active segment
+        sizes = {seq: os.path.getsize(self._path(seq)) for seq in segments}
+        total = sum(sizes.values())
+        deadline = time.time() - self.max_age
+        for seq in segments:
+            path = self._path(seq)
+            if total <= self.max_bytes and os.path.getmtime(path) >= deadline:
+                break
+            os.remove(path)
+            total -= sizes[seq]
+
+    def append(self, event: Event) -> int:
+        if self._segment is None or self._segment.tell() >= self.segment_size:
+            self._roll()
+
+        # the record is the event payload itself, so it is encoded once for the log and every sink
+        event.seq = self.last_seq + 1
+        self._segment.write(event.encoded + b"\n")
+        self._segment.flush()
+        self.last_seq = event.seq
+        return event.seq
+
+    def read_since(self, since: int) -> Iterator[Event]:
+        """ Yield every retained event whose sequence number is greater than since. """
+        segments = self._segments()
+        start = max((i for i, first_seq in enumerate(segments) if first_seq <= since + 1), default=0)
+        for first_seq in segments[start:]:
+            try:
+                f = open(self._path(first_seq), mode="rb")
+            except FileNotFoundError:  # removed by retention
+                continue
+            with f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    if (event := Event.load(line[:-1])).seq > since:
+                        yield event
+
+    def close(self):
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
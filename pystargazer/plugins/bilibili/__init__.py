@@ -14,6 +14,13 @@ bilibili = Bilibili()
 
 get_option = _get_option(app, "bilibili")
 
+# markers of the last dynamic seen of each vtuber, refreshed while the vtuber is tracked
+SINCE_TTL = 30 * 24 * 3600
+
+
+def since_key(name: str) -> str:
+    return f"bilibili_since:{name}"
+
 
 @app.route("/help/bilibili", methods=["GET"])
 async def youtube_help(request: Request):
@@ -26,10 +33,15 @@ async def youtube_help(request: Request):
 
 @app.on_startup
 async def bilibili_setup():
+    await app.vtubers.create_index("bilibili")
     try:
-        await app.plugin_state.get("bilibili_since")
+        legacy_since = await app.plugin_state.get("bilibili_since")
     except KeyError:
-        await app.plugin_state.put(KVPair("bilibili_since", {}))
+        return
+    # split the since map of older versions into markers
+    await app.plugin_state.put_many(KVPair(since_key(name), {"since": since}).expire_in(SINCE_TTL)
+                                    for name, since in legacy_since.value.items())
+    await app.plugin_state.delete(legacy_since)
 
 
 @app.scheduled("interval", minutes=5, misfire_grace_time=10)
@@ -37,22 +49,25 @@ async def bilibili_task():
     if await get_option("disabled"):
         return
 
-    b_since: KVPair = await app.plugin_state.get("bilibili_since")
-
     b_valid_ids = []
     b_names = []
     # noinspection PyTypeChecker
-    async for vtuber in app.vtubers.has_field("bilibili"):
+    async for vtuber in app.vtubers.has_field("bilibili", ["bilibili"]):
         b_names.append(vtuber.key)
         b_valid_ids.append(vtuber.value["bilibili"])
 
-    dyns = await asyncio.gather(*(bilibili.fetch(b_id, b_since.value.get(b_name, 1))
+    markers = await app.plugin_state.get_many(since_key(name) for name in b_names)
+    b_since = {name: marker.value["since"] for name in b_names if (marker := markers.get(since_key(name)))}
+    dyns = await asyncio.gather(*(bilibili.fetch(b_id, b_since.get(b_name, 1))
                                   for b_name, b_id in zip(b_names, b_valid_ids)))
 
     valid_dyns = {name: dyn for name, dyn in zip(b_names, dyns) if dyn[1]}
     since = {name: dyn[0] for name, dyn in valid_dyns.items()}
-    b_since.value.update(since)
-    await app.plugin_state.put(b_since)
+    # refresh the markers of tracked vtubers halfway, so that only those of vtubers no longer tracked expire
+    since.update((name, b_since[name]) for name in b_names
+                 if name not in since and name in b_since and markers[since_key(name)].ttl < SINCE_TTL / 2)
+    await app.plugin_state.put_many(KVPair(since_key(name), {"since": since_id}).expire_in(SINCE_TTL)
+                                    for name, since_id in since.items())
 
     dyn: Dynamic
     events = (
@@ -64,4 +79,4 @@ async def bilibili_task():
         for name, dyn_set in valid_dyns.items()
         for dyn in dyn_set[1]
     )
-    await asyncio.gather(*(app.send_event(event) for event in events))
+    await app.send_events(events)
@@ -1,4 +1,5 @@
 import asyncio
+import time
 from typing import Dict
 
 from httpx import AsyncClient
@@ -13,18 +14,19 @@ map_uid_client: Dict[int, LiveClient] = {}
 
 
 async def get_vtuber_by_uid(uid: int) -> KVPair:
-    # noinspection PyTypeChecker
-    async for vtuber in app.vtubers.has_field("bilibili"):
-        if int(vtuber.value["bilibili"]) == uid:
-            return vtuber
+    try:
+        return await app.vtubers.find_by("bilibili", uid)
+    except KeyError:
+        pass
 
 
 @app.scheduled(None, misfire_grace_time=10)
 async def init_ws():
+    await app.vtubers.create_index("bilibili")
     await asyncio.sleep(5)
 
     bili_uids = []
-    async for vtuber in app.vtubers.has_field("bilibili"):
+    async for vtuber in app.vtubers.has_field("bilibili", ["bilibili"]):
         bili_uids.append(int(vtuber.value["bilibili"]))
 
     global map_uid_client
@@ -47,42 +49,44 @@ async def close_ws():
     await asyncio.gather(*(stop_client(client) for client in map_uid_client.values()))
 
 
-@app.on_update("vtubers")
+async def start_client(uid: int):
+    if uid in map_uid_client:
+        return
+    roomid = await get_room_id(uid)
+    if not roomid:
+        return
+    map_uid_client[uid] = (client := LiveClient(roomid, on_live=on_live))
+    await client.init_room()
+    client.start()
+
+
+async def stop_client(uid: int):
+    if (client := map_uid_client.pop(uid, None)) is not None:
+        await client.close()
+
+
+@app.on_update("vtubers", fields=["bilibili"])
 async def on_update(obj: KVPair, added: dict, removed: dict, updated: dict):
     if "bilibili" in added:
-        uid = int(added["bilibili"])
-        if uid in map_uid_client.keys():
-            return
-        roomid = await get_room_id(uid)
-        if not roomid:
-            return
-        map_uid_client[uid] = (client := LiveClient(roomid, on_live=on_live))
-        await client.init_room()
-        client.start()
+        await start_client(int(added["bilibili"]))
     elif "bilibili" in removed:
-        uid = removed["youtube"]
-        if uid not in map_uid_client.keys():
-            return
-        await map_uid_client[uid].close()
-        map_uid_client.pop(uid)
+        await stop_client(int(removed["bilibili"]))
     elif "bilibili" in updated:
-        old_uid, new_uid = updated["youtube"]
-        if old_uid in map_uid_client.keys():
-            await map_uid_client[old_uid].close()
-            map_uid_client.pop(old_uid)
-        if new_uid not in map_uid_client.keys():
-            roomid = await get_room_id(new_uid)
-            if roomid:
-                map_uid_client[new_uid] = (client := LiveClient(roomid, on_live=on_live))
-                await client.init_room()
-                client.start()
-
-
-@app.on_create("vtubers")
+        old_uid, new_uid = updated["bilibili"]
+        await stop_client(int(old_uid))
+        await start_client(int(new_uid))
+
+
+@app.on_create("vtubers", fields=["bilibili"])
+async def on_create(obj: KVPair):
+    if uid := obj.value.get("bilibili"):
+        await start_client(int(uid))
+
+
+@app.on_delete("vtubers", fields=["bilibili"])
 async def on_delete(obj: KVPair):
-    if (uid := obj.value.get("bilibili")) and uid in map_uid_client:
-        await map_uid_client[uid].close()
-        map_uid_client.pop(uid)
+    if uid := obj.value.get("bilibili"):
+        await stop_client(int(uid))
 
 
 async def on_live(client: LiveClient, command: dict):
@@ -93,5 +97,10 @@ async def on_live(client: LiveClient, command: dict):
         "link": f"https://live.bilibili.com/{client.room_id}",
         "images": [cover] if (cover := live_room.cover) else []
     }
-    event = Event("bili_live", vtuber.key, body)
+    # the room link is the same for every broadcast, so identify the event by its start time
+    if (live_time := live_room.live_time) and not live_time.startswith("0000"):
+        event_id = f"{client.room_id}@{live_time}"
+    else:
+        event_id = f"{client.room_id}@{int(time.time())}"
+    event = Event("bili_live", vtuber.key, body, event_id)
     await app.send_event(event)
@@ -34,6 +34,7 @@ class LiveRoom:
     uid: int
     cover: str
     status: LiveStatus
+    live_time: Optional[str] = None
 
     @classmethod
     async def from_room_id(cls, room_id: int):
@@ -57,7 +58,8 @@ class LiveRoom:
             return None
 
         data = json_data['data']
-        return cls(room_id, data["title"], data["uid"], data["user_cover"], LiveStatus(data["live_status"]))
+        return cls(room_id, data["title"], data["uid"], data["user_cover"], LiveStatus(data["live_status"]),
+                   data.get("live_time"))
 
 
 async def get_room_id(uid: int) -> Optional[int]:
@@ -4,7 +4,7 @@ from starlette.authentication import requires
 from starlette.endpoints import HTTPEndpoint
 from starlette.requests import Request
 from starlette.responses import JSONResponse, PlainTextResponse, RedirectResponse, Response
-from starlette.status import HTTP_201_CREATED, HTTP_404_NOT_FOUND, HTTP_409_CONFLICT
+from starlette.status import HTTP_201_CREATED, HTTP_400_BAD_REQUEST, HTTP_404_NOT_FOUND, HTTP_409_CONFLICT
 
 from pystargazer.app import app
 from pystargazer.models import KVContainer, KVPair
@@ -25,6 +25,14 @@ class LoadedPluginsEP(HTTPEndpoint):
     async def get(self, request: Request):
         return JSONResponse(list(app.plugins.keys()))
 
+
+@app.route("/api/stats")
+class StatsEP(HTTPEndpoint):
+    @requires(["admin"])
+    async def get(self, request: Request):
+        return JSONResponse(app.stats())
+
+
 @app.route("/api/{table}")
 class RootEP(HTTPEndpoint):
     async def get(self, request: Request):
@@ -33,10 +41,21 @@ class RootEP(HTTPEndpoint):
         except KeyError:
             return PlainTextResponse("Not Found", status_code=HTTP_404_NOT_FOUND)
 
+        # paginate with /api/{table}?limit=<n>&cursor=<X-Next-Cursor of the previous page>
+        try:
+            limit = int(request.query_params["limit"]) if "limit" in request.query_params else None
+            if limit is not None and limit < 1:
+                raise ValueError
+        except ValueError:
+            return PlainTextResponse("Bad Request", status_code=HTTP_400_BAD_REQUEST)
+        cursor = request.query_params.get("cursor")
+
         keys = []
         # noinspection PyTypeChecker
-        async for doc in table.iter():
+        async for doc in table.iter([], min(limit or 256, 256), cursor):
             keys.append(doc.key)
+            if len(keys) == limit:
+                return JSONResponse(keys, headers={"X-Next-Cursor": doc.key})
 
         return JSONResponse(keys)
 
@@ -51,11 +70,30 @@ class RootEP(HTTPEndpoint):
         try:
             await table.get(key)
         except KeyError:
-            await table.put(KVPair(key, {}))
+            await table.put_detached(KVPair(key, {}))
             return RedirectResponse(url=urljoin(app.credentials.get("base_url"), key), status_code=HTTP_201_CREATED)
 
         return PlainTextResponse("Conflict", status_code=HTTP_409_CONFLICT)
 
+    @requires(["admin"])
+    async def put(self, request: Request):
+        try:
+            table = get_table(request.path_params["table"])
+        except KeyError:
+            return PlainTextResponse("Not Found", status_code=HTTP_404_NOT_FOUND)
+
+        # bulk upsert: {"<prime_key>": {"<key>": "<value>", ...}, ...}
+        try:
+            body = await request.json()
+            if not isinstance(body, dict) or not all(isinstance(value, dict) for value in body.values()):
+                raise ValueError
+            docs = [KVPair(key, value) for key, value in body.items()]
+        except ValueError:
+            return PlainTextResponse("Bad Request", status_code=HTTP_400_BAD_REQUEST)
+
+        await table.put_many_detached(docs)
+        return Response()
+
 
 @app.route("/api/{table}/{prime_key}")
 class EntryEP(HTTPEndpoint):
@@ -83,7 +121,7 @@ class EntryEP(HTTPEndpoint):
         except KeyError:
             return PlainTextResponse("Not Found", status_code=HTTP_404_NOT_FOUND)
 
-        await table.delete(KVPair(key, {}))
+        await table.delete_detached(KVPair(key, {}))
         return Response()
 
 
@@ -115,7 +153,7 @@ class KeyEP(HTTPEndpoint):
 
         prime_key = request.path_params["prime_key"]
         try:
-            prime_value = await table.get(prime_key)
+            prime_value = await table.get(prime_key, track=True)
         except KeyError:
             return PlainTextResponse("Not Found", status_code=HTTP_404_NOT_FOUND)
 
@@ -124,7 +162,7 @@ class KeyEP(HTTPEndpoint):
 
         prime_value.value[key] = value
 
-        await table.put(prime_value)
+        await table.put_detached(prime_value)
         return Response()
 
     @requires(["admin"])
@@ -136,7 +174,7 @@ class KeyEP(HTTPEndpoint):
 
         prime_key = request.path_params["prime_key"]
         try:
-            prime_value = await table.get(prime_key)
+            prime_value = await table.get(prime_key, track=True)
         except KeyError:
             return PlainTextResponse("Not Found", status_code=HTTP_404_NOT_FOUND)
         
@@ -146,5 +184,5 @@ class KeyEP(HTTPEndpoint):
 
         prime_value.value.pop(key)
 
-        await table.put(prime_value)
+        await table.put_detached(prime_value)
         return Response()
@@ -11,6 +11,13 @@ from .models import Tweet
 
 twitter = Twitter(app.credentials.get("twitter"))
 
+# markers of the last tweet seen of each vtuber, refreshed while the vtuber is tracked
+SINCE_TTL = 30 * 24 * 3600
+
+
+def since_key(name: str) -> str:
+    return f"twitter_since:{name}"
+
 
 @app.route("/help/twitter", methods=["GET"])
 async def youtube_help(request: Request):
@@ -23,30 +30,38 @@ async def youtube_help(request: Request):
 
 @app.on_startup
 async def twitter_startup():
+    await app.vtubers.create_index("twitter")
     try:
-        await app.plugin_state.get("twitter_since")
+        legacy_since = await app.plugin_state.get("twitter_since")
     except KeyError:
-        await app.plugin_state.put(KVPair("twitter_since", {}))
+        return
+    # split the since map of older versions into markers
+    await app.plugin_state.put_many(KVPair(since_key(name), {"since": since}).expire_in(SINCE_TTL)
+                                    for name, since in legacy_since.value.items())
+    await app.plugin_state.delete(legacy_since)
 
 
 @app.scheduled("interval", minutes=1, misfire_grace_time=10)
 async def twitter_task():
-    t_since: KVPair = await app.plugin_state.get("twitter_since")
-
     t_valid_ids = []
     t_names = []
     # noinspection PyTypeChecker
-    async for vtuber in app.vtubers.has_field("twitter"):
+    async for vtuber in app.vtubers.has_field("twitter", ["twitter"]):
         t_names.append(vtuber.key)
         t_valid_ids.append(vtuber.value["twitter"])
 
-    tweets = await asyncio.gather(*(twitter.fetch(t_id, t_since.value.get(t_name, 1))
+    markers = await app.plugin_state.get_many(since_key(name) for name in t_names)
+    t_since = {name: marker.value["since"] for name in t_names if (marker := markers.get(since_key(name)))}
+    tweets = await asyncio.gather(*(twitter.fetch(t_id, t_since.get(t_name, 1))
                                     for t_name, t_id in zip(t_names, t_valid_ids)))
 
     valid_tweets = {name: tweet for name, tweet in zip(t_names, tweets) if tweet[1]}
     since = {name: tweet[0] for name, tweet in valid_tweets.items()}
-    t_since.value.update(since)
-    await app.plugin_state.put(t_since)
+    # refresh the markers of tracked vtubers halfway, so that only those of vtubers no longer tracked expire
+    since.update((name, t_since[name]) for name in t_names
+                 if name not in since and name in t_since and markers[since_key(name)].ttl < SINCE_TTL / 2)
+    await app.plugin_state.put_many(KVPair(since_key(name), {"since": since_id}).expire_in(SINCE_TTL)
+                                    for name, since_id in since.items())
 
     tweet: Tweet
     events = (
@@ -57,4 +72,4 @@ async def twitter_task():
         )
         for name, tweet_set in valid_tweets.items()
         for tweet in tweet_set[1])
-    await asyncio.gather(*(app.send_event(event) for event in events))
+    await app.send_events(events)
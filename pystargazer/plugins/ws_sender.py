@@ -1,25 +1,230 @@
-from typing import List
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from itertools import islice
+from os import environ
+from typing import Dict, Iterable, List, Optional, Set
 
 from starlette.endpoints import WebSocket, WebSocketEndpoint
+from starlette.status import WS_1008_POLICY_VIOLATION, WS_1013_TRY_AGAIN_LATER
 
 from pystargazer.app import app
 from pystargazer.models import Event
+from pystargazer.utils import strtobool
 
-ws_clients: List[WebSocket] = []
+max_lag = int(environ.get("WS_MAX_LAG", "1024"))
+write_timeout = float(environ.get("WS_WRITE_TIMEOUT", "10"))
+
+counters = {
+    "evicted": 0,
+    "timeouts": 0,
+    "dropped": 0
+}
+
+
+class Client:
+    def __init__(self, websocket: WebSocket, batch: bool = False,
+                 vtubers: Optional[Iterable[str]] = None, types: Optional[Iterable[str]] = None):
+        self.websocket = websocket
+        # whether the client asked for batched frames (/ws?batch=true)
+        self.batch = batch
+        # subscription filters, None matches everything
+        self.vtubers: Optional[Set[str]] = set(vtubers) if vtubers is not None else None
+        self.types: Optional[Set[str]] = set(types) if types is not None else None
+        self.last_seq = 0
+        # outbound batches and the number of events they hold
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.lag = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def accepts(self, event: Event) -> bool:
+        return (self.types is None or event.type in self.types) and \
+               (self.vtubers is None or event.vtuber in self.vtubers)
+
+    def start(self, since: Optional[int] = None):
+        self.task = asyncio.ensure_future(self._run(since))
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def put(self, events: List[Event]):
+        if self.lag + len(events) > max_lag:
+            logging.warning(f"Websocket client {self.websocket.client} lags behind. Evicting.")
+            counters["dropped"] += self.lag + len(events)
+            self.evict()
+            return
+        self.queue.put_nowait(events)
+        self.lag += len(events)
+
+    def evict(self):
+        counters["evicted"] += 1
+        unregister(self.websocket)
+        self.stop()
+        asyncio.ensure_future(self._close())
+
+    async def _close(self):
+        # noinspection PyBroadException
+        try:
+            await asyncio.wait_for(self.websocket.close(code=WS_1013_TRY_AGAIN_LATER), write_timeout)
+        except Exception:
+            pass
+
+    async def _send(self, events: List[Event]):
+        payloads = [event.text for event in events if event.seq is None or event.seq > self.last_seq]
+        if not payloads:
+            return
+
+        if self.batch:
+            await asyncio.wait_for(self.websocket.send_text(f"[{','.join(payloads)}]"), write_timeout)
+        else:
+            for payload in payloads:
+                await asyncio.wait_for(self.websocket.send_text(payload), write_timeout)
+        self.last_seq = max((event.seq for event in events if event.seq is not None), default=self.last_seq)
+
+    async def _run(self, since: Optional[int]):
+        # noinspection PyBroadException
+        try:
+            # resume from the outbox before switching to live events, which are queued meanwhile
+            if since is not None and app.outbox:
+                missed = filter(self.accepts, app.outbox.read_since(since))
+                while chunk := list(islice(missed, 256)):
+                    await self._send(chunk)
+            while True:
+                events = await self.queue.get()
+                self.lag -= len(events)
+                await self._send(events)
+        except asyncio.TimeoutError:
+            logging.warning(f"Websocket client {self.websocket.client} write timeout. Evicting.")
+            counters["timeouts"] += 1
+            counters["dropped"] += self.lag
+            self.task = None
+            self.evict()
+        except Exception:
+            logging.exception(f"Failed to send events to websocket client {self.websocket.client}.")
+            unregister(self.websocket)
+
+
+class SubscriptionIndex:
+    """ Inverted index from event type and vtuber to the subscribed clients. """
+
+    def __init__(self):
+        self.by_type: Dict[str, Set[Client]] = defaultdict(set)
+        self.by_vtuber: Dict[str, Set[Client]] = defaultdict(set)
+        self.any_type: Set[Client] = set()
+        self.any_vtuber: Set[Client] = set()
+
+    @staticmethod
+    def _add(index: Dict[str, Set[Client]], wildcard: Set[Client], keys: Optional[Set[str]], client: Client):
+        if keys is None:
+            wildcard.add(client)
+        for key in keys or ():
+            index[key].add(client)
+
+    @staticmethod
+    def _remove(index: Dict[str, Set[Client]], wildcard: Set[Client], keys: Optional[Set[str]], client: Client):
+        wildcard.discard(client)
+        for key in keys or ():
+            if clients := index.get(key):
+                clients.discard(client)
+                if not clients:
+                    index.pop(key)
+
+    def add(self, client: Client):
+        self._add(self.by_type, self.any_type, client.types, client)
+        self._add(self.by_vtuber, self.any_vtuber, client.vtubers, client)
+
+    def remove(self, client: Client):
+        self._remove(self.by_type, self.any_type, client.types, client)
+        self._remove(self.by_vtuber, self.any_vtuber, client.vtubers, client)
+
+    def match(self, event: Event) -> Set[Client]:
+        by_type = self.by_type.get(event.type, set())
+        by_vtuber = self.by_vtuber.get(event.vtuber, set())
+        return (by_type | self.any_type) & (by_vtuber | self.any_vtuber)
+
+
+ws_clients: Dict[WebSocket, Client] = {}
+subscriptions = SubscriptionIndex()
+
+
+def register(client: Client):
+    ws_clients[client.websocket] = client
+    subscriptions.add(client)
+
+
+def unregister(websocket: WebSocket) -> Optional[Client]:
+    if client := ws_clients.pop(websocket, None):
+        subscriptions.remove(client)
+    return client
+
+
+def parse_filter(value: Optional[str]) -> Optional[List[str]]:
+    return [item.strip() for item in value.split(",") if item.strip()] if value is not None else None
+
+
+def valid_filter(value) -> bool:
+    return value is None or isinstance(value, list) and all(isinstance(item, str) for item in value)
 
 
 @app.ws_route("/ws")
 class EventEndPoint(WebSocketEndpoint):
+    encoding = "text"
+
     async def on_connect(self, websocket: WebSocket) -> None:
         await super().on_connect(websocket)
-        ws_clients.append(websocket)
+        # /ws?batch=true&vtuber=suisei,miko&type=bili_live,ytb_live
+        params = websocket.query_params
+        # resume from the outbox with /ws?since=<seq>
+        try:
+            since = int(since) if (since := params.get("since")) is not None else None
+        except ValueError:
+            await websocket.close(code=WS_1008_POLICY_VIOLATION)
+            return
+        client = Client(websocket, strtobool(params.get("batch")),
+                        parse_filter(params.get("vtuber")), parse_filter(params.get("type")))
+        register(client)
+        client.start(since)
+
+    async def on_receive(self, websocket: WebSocket, data: str) -> None:
+        # {"subscribe": {"vtubers": ["suisei"], "types": null}} replaces the filters of this client
+        try:
+            subscribe = json.loads(data)["subscribe"]
+            vtubers, types = subscribe.get("vtubers"), subscribe.get("types")
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return
+        if not all(valid_filter(value) for value in (vtubers, types)):
+            return
+        if (client := ws_clients.get(websocket)) is None:
+            return
+
+        subscriptions.remove(client)
+        client.vtubers = set(vtubers) if vtubers is not None else None
+        client.types = set(types) if types is not None else None
+        subscriptions.add(client)
 
     async def on_disconnect(self, websocket: WebSocket, close_code: int) -> None:
         await super().on_disconnect(websocket, close_code)
-        ws_clients.remove(websocket)
+        if client := unregister(websocket):
+            client.stop()
+
+
+@app.batch_dispatcher
+async def ws_send(events: List[Event]):
+    client_events: Dict[Client, List[Event]] = defaultdict(list)
+    for event in events:
+        for client in subscriptions.match(event):
+            client_events[client].append(event)
+    for client, _events in client_events.items():
+        client.put(_events)
 
 
-@app.dispatcher
-async def ws_send(event: Event):
-    for client in ws_clients:
-        await client.send_json(event.to_json())
+@app.stats_provider("ws_sender")
+def ws_stats() -> dict:
+    return {
+        "clients": len(ws_clients),
+        "max_client_lag": max((client.lag for client in ws_clients.values()), default=0),
+        **counters
+    }
@@ -1,9 +1,11 @@
 import asyncio
+import calendar
 import datetime
 import logging
+import time
 from functools import partial
 from itertools import tee
-from typing import Dict, Iterator, List, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple
 from urllib.parse import parse_qs, urljoin, urlparse
 
 import feedparser
@@ -24,21 +26,37 @@ from .models import ResourceType, Video, YoutubeEvent, YoutubeEventType
 
 callback_url: str = app.credentials.get("base_url")
 channel_list: Dict[str, List[Video]] = {}
-read_list: List[Video] = []
 scheduler = app.scheduler
 http = AsyncClient()
 
 
+def read_key(video_id: str) -> str:
+    return f"youtube_read:{video_id}"
+
+
 @app.on_startup
 async def startup():
     global channel_list
+    await app.vtubers.create_index("youtube")
     # noinspection PyTypeChecker
-    async for vtuber in app.vtubers.has_field("youtube"):
+    async for vtuber in app.vtubers.has_field("youtube", ["youtube"]):
         channel_list[vtuber.value["youtube"]] = []
 
+    await migrate_read_list()
     await load_state()
 
 
+async def migrate_read_list():
+    try:
+        read_state = await app.plugin_state.get("youtube_video_state")
+    except KeyError:
+        return
+    # the read list of older versions, kept as markers until the dedup index covers the same period
+    await app.plugin_state.put_many(KVPair(read_key(video["video_id"]), {}).expire_in(app.dedup.ttl)
+                                    for video in read_state.value.get("videos", []))
+    await app.plugin_state.delete(read_state)
+
+
 @app.on_shutdown
 async def shutdown():
     await dump_state()
@@ -56,7 +74,7 @@ async def init_subscribe():
 
     channel_ids: List[str] = []
     # noinspection PyTypeChecker
-    async for vtuber in app.vtubers.has_field("youtube"):
+    async for vtuber in app.vtubers.has_field("youtube", ["youtube"]):
         channel_ids.append(vtuber.value["youtube"])
 
     logging.info(f"Subscribing: {channel_ids}")
@@ -75,10 +93,10 @@ async def youtube_help(request: Request):
 
 
 async def get_vtuber(channel_id: str) -> KVPair:
-    # noinspection PyTypeChecker
-    async for vtuber in app.vtubers.has_field("youtube"):
-        if vtuber.value["youtube"] == channel_id:
-            return vtuber
+    try:
+        return await app.vtubers.find_by("youtube", channel_id)
+    except KeyError:
+        pass
 
 
 async def send_youtube_event(ytb_event: YoutubeEvent):
@@ -102,7 +120,14 @@ async def send_youtube_event(ytb_event: YoutubeEvent):
     if actual_start_time_print:
         body["actual_start_time"] = actual_start_time_print
 
-    event = Event(ytb_event.event.value, vtuber.key, body)
+    # schedule and reminder events are sent again when the broadcast is rescheduled
+    event_id = None
+    if ytb_event.event == YoutubeEventType.SCHEDULE:
+        event_id = f"{video.video_id}@{video.scheduled_start_time.timestamp()}:{video.title}"
+    elif ytb_event.event == YoutubeEventType.REMINDER:
+        event_id = f"{video.video_id}@{video.scheduled_start_time.timestamp()}"
+
+    event = Event(ytb_event.event.value, vtuber.key, body, event_id)
 
     await app.send_event(event)
 
@@ -166,17 +191,18 @@ class WebsubEndpoint(HTTPEndpoint):
 
     # noinspection PyMethodMayBeStatic
     async def post(self, request: Request):
-        def parse_feed(data: str) -> Tuple[str, str, str, str]:
+        def parse_feed(data: str) -> Tuple[str, str, str, str, Optional[float]]:
             feed = feedparser.parse(data)
             entry = feed.entries[0]
-            return entry.yt_videoid, entry.link, entry.title, entry.yt_channelid
+            published = calendar.timegm(parsed) if (parsed := entry.get("published_parsed")) else None
+            return entry.yt_videoid, entry.link, entry.title, entry.yt_channelid, published
 
         body = (await request.body()).decode("utf-8")
         logging.debug(body)
         if "deleted-entry" in body:
             return Response()
 
-        video_id, video_link, video_title, channel_id = parse_feed(body)
+        video_id, video_link, video_title, channel_id, published = parse_feed(body)
         video = Video(video_id)
 
         logging.info(f"Adding video {video_id}")
@@ -186,16 +212,19 @@ class WebsubEndpoint(HTTPEndpoint):
             return Response()
 
         if video.type == ResourceType.VIDEO:
-            # check whether the video is already in the read_list
+            if published is not None and time.time() - published > app.dedup.ttl:
+                # edits of videos older than the dedup index are notified again
+                logging.info(f"Ignoring update of old video {video_id}")
+                return Response()
             try:
-                next(_video for _video in read_list if video.video_id == _video.video_id)
-                logging.info("Duplicate video. Ignoring.")
+                await app.plugin_state.get(read_key(video_id))
+                logging.info(f"Ignoring update of video {video_id} read before the dedup index")
                 return Response()
-            except StopIteration:
+            except KeyError:
                 pass
+            # duplicated notifications are dropped by the event dedup index
             event = YoutubeEvent(type=video.type, event=YoutubeEventType.PUBLISH, channel=channel_id, video=video)
             await send_youtube_event(event)
-            read_list.append(video)
         elif video.type == ResourceType.BROADCAST and not video.actual_start_time:
             if not video.scheduled_start_time:
                 logging.warning("Malformed video object: missing scheduled start time.")
@@ -248,7 +277,7 @@ class WebsubEndpoint(HTTPEndpoint):
 
 
 # noinspection PyUnusedLocal
-@app.on_update("vtubers")
+@app.on_update("vtubers", fields=["youtube"])
 async def on_update(obj: KVPair, added: dict, removed: dict, updated: dict):
     if "youtube" in added:
         await subscribe(added["youtube"])
@@ -260,7 +289,13 @@ async def on_update(obj: KVPair, added: dict, removed: dict, updated: dict):
         await subscribe(new_id)
 
 
-@app.on_delete("vtubers")
+@app.on_create("vtubers", fields=["youtube"])
+async def on_create(obj: KVPair):
+    if yid := obj.value.get("youtube"):
+        await subscribe(yid)
+
+
+@app.on_delete("vtubers", fields=["youtube"])
 async def on_delete(obj: KVPair):
     if yid := obj.value.get("youtube"):
         await unsubscribe(yid)
@@ -330,17 +365,11 @@ async def cleanup():
 
 async def load_state():
     global channel_list
-    global read_list
     try:
         channel_state = await app.plugin_state.get("youtube_live_state")
     except KeyError:
         logging.warning("Missing live state dict. Ignoring.")
         channel_state = KVPair("youtube_live_state", {})
-    try:
-        read_state = await app.plugin_state.get("youtube_video_state")
-    except KeyError:
-        logging.warning("Missing video state dict. Ignoring.")
-        read_state = KVPair("youtube_video_state", {"videos": []})
 
     for channel, videos in channel_state.value.items():
         for _video in videos:
@@ -361,12 +390,8 @@ async def load_state():
                                       second=reminder_time.second)
                 channel_list[channel].append(video)
 
-    read_list = [Video.load(video) for video in read_state.value["videos"]]
-
 
 async def dump_state():
     channel_state = {channel: [video.dump() for video in videos] for channel, videos in channel_list.items()}
-    read_state = {"videos": [video.dump() for video in read_list]}
 
     await app.plugin_state.put(KVPair("youtube_live_state", channel_state))
-    await app.plugin_state.put(KVPair("youtube_video_state", read_state))
@@ -0,0 +1,52 @@
+import asyncio
+import heapq
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class ExpiryHeap:
+    """ Min-heap of document deadlines, calling expire with the key of each document once its deadline has passed. """
+
+    def __init__(self, expire: Callable[[str], None]):
+        self.expire = expire
+        # current deadline of each key, heap entries not matching it are stale
+        self._deadlines: Dict[str, float] = {}
+        self._heap: List[Tuple[float, str]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def set(self, key: str, deadline: Optional[float]):
+        if deadline is None:
+            self._deadlines.pop(key, None)
+            return
+        if self._deadlines.get(key) == deadline:
+            return
+
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            # drop the entries of rewritten documents
+            self._heap = [(deadline, key) for key, deadline in self._deadlines.items()]
+            heapq.heapify(self._heap)
+            self._arm()
+        elif self._heap[0] == (deadline, key):
+            self._arm()
+
+    def _arm(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._heap:
+            self._timer = asyncio.get_event_loop().call_later(max(self._heap[0][0] - time.time(), 0), self._sweep)
+
+    def _sweep(self):
+        self._timer = None
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            deadline, key = heapq.heappop(self._heap)
+            if self._deadlines.get(key) == deadline:
+                del self._deadlines[key]
+                self.expire(key)
+        self._arm()
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
@@ -1,21 +1,91 @@
-from typing import AsyncGenerator, Optional, Tuple
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from typing import Any, AsyncGenerator, Dict, Iterable, List, Optional, Set, Tuple
 from urllib.parse import urlparse
 
-from tinydb import TinyDB, where
-from tinydb.database import Document
+from tinydb import TinyDB
 
-from pystargazer.models import AbstractKVContainer, KVPair
+from pystargazer.models import AbstractKVContainer, EXPIRE_AT, KVPair
+from pystargazer.storages.expiry import ExpiryHeap
+
+
+class FileDatabase:
+    """
+    TinyDB file shared by the containers of all its tables.
+
+    Every table is held in memory and serves the reads, while the file is written as a whole by a dedicated thread.
+    Writes of any table made while the file is being written are coalesced into the next one.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = TinyDB(path)
+        # tables not opened yet are written back as read
+        self._raw: Dict[str, Dict[str, dict]] = self.db.storage.read() or {}
+        # table -> key -> document, stored documents are replaced, never mutated
+        self.tables: Dict[str, Dict[str, dict]] = {}
+
+        self._dirty = False
+        self._flushing: Optional[asyncio.Future] = None
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="file-storage")
+
+    def table(self, name: str) -> Dict[str, dict]:
+        if (table := self.tables.get(name)) is None:
+            table = self.tables[name] = {doc["key"]: doc for doc in self._raw.pop(name, {}).values()}
+        return table
+
+    def _write(self, raw: Dict[str, Dict[str, dict]], tables: Dict[str, List[dict]]):
+        for name, docs in tables.items():
+            raw[name] = {str(doc_id): doc for doc_id, doc in enumerate(docs, 1)}
+        self.db.storage.write(raw)
+
+    async def _flush(self):
+        loop = asyncio.get_event_loop()
+        while self._dirty:
+            self._dirty = False
+            tables = {name: list(table.values()) for name, table in self.tables.items()}
+            # noinspection PyBroadException
+            try:
+                await loop.run_in_executor(self._writer, self._write, dict(self._raw), tables)
+            except Exception:
+                logging.exception(f"Failed to write {self.path}.")
+
+    def schedule_flush(self):
+        self._dirty = True
+        if self._flushing is None or self._flushing.done():
+            self._flushing = asyncio.ensure_future(self._flush())
+
+    async def flush(self):
+        if self._flushing is not None:
+            await self._flushing
+
+
+# databases by path, shared by the containers of every table stored in the same file
+_databases: Dict[str, FileDatabase] = {}
+
+
+def get_database(path: str) -> FileDatabase:
+    if (database := _databases.get(key := os.path.abspath(path))) is None:
+        database = _databases[key] = FileDatabase(path)
+    return database
 
 
 class FileKVContainer(AbstractKVContainer):
+    """ Table of a TinyDB file, see FileDatabase. """
+
     async def delete(self, obj: KVPair) -> KVPair:
-        doc: Document = self.table.search(where("key") == obj.key)[0]
-        self.table.remove(doc_ids=[doc.doc_id])
+        doc = self._docs.pop(obj.key)
+        self._unindex(obj.key)
+        self.database.schedule_flush()
         return KVPair.load(doc)
 
-    async def iter(self) -> AsyncGenerator[KVPair, None]:
-        for doc in self.table.all():
-            yield KVPair.load(doc)
+    async def iter(self, projection: Optional[List[str]] = None, batch_size: int = 256,
+                   after: Optional[str] = None) -> AsyncGenerator[KVPair, None]:
+        async for obj in self._scan(list(self._docs), projection, batch_size, after):
+            yield obj
 
     def __init__(self, url: str):
         super().__init__()
@@ -26,26 +96,99 @@ class FileKVContainer(AbstractKVContainer):
         ])
         table = parsed_url.path.split("/")[-1]
 
-        self.db = TinyDB(db)
-        self.table = self.db.table(table)
+        self.database = get_database(db)
+        self._docs: Dict[str, dict] = self.database.table(table)
+
+        # field -> keys of the documents having the field, built on first use of the field
+        self._indexes: Dict[str, Set[str]] = {}
+
+        self._expiry = ExpiryHeap(self._expire)
+        for key, doc in self._docs.items():
+            self._expiry.set(key, doc.get(EXPIRE_AT))
+
+    async def flush(self):
+        await self.database.flush()
+
+    def _store(self, doc: dict):
+        self._docs[doc["key"]] = doc = deepcopy(doc)
+        for field, index in self._indexes.items():
+            if field in doc:
+                index.add(doc["key"])
+            else:
+                index.discard(doc["key"])
+        self._expiry.set(doc["key"], doc.get(EXPIRE_AT))
+
+    def _unindex(self, key: str):
+        for index in self._indexes.values():
+            index.discard(key)
+        self._expiry.set(key, None)
+
+    def _expire(self, key: str):
+        del self._docs[key]
+        self._unindex(key)
+        self.database.schedule_flush()
+
+    async def _scan(self, keys: Iterable[str], projection: Optional[List[str]], batch_size: int,
+                    after: Optional[str]) -> AsyncGenerator[KVPair, None]:
+        for i, key in enumerate(sorted(key for key in keys if after is None or key > after), 1):
+            if key in self._docs:
+                if projection == []:
+                    yield KVPair(key, {})
+                else:
+                    yield KVPair.load(deepcopy(self._docs[key])).project(projection)
+            if i % batch_size == 0:
+                # let other tasks run between batches
+                await asyncio.sleep(0)
+
+    async def create_index(self, field: str):
+        if field not in self._indexes:
+            self._indexes[field] = {key for key, doc in self._docs.items() if field in doc}
 
     async def get(self, key: str) -> KVPair:
-        docs: dict = self.table.search(where("key") == key)
-        return KVPair.load(docs[0]) if docs else None
+        return KVPair.load(deepcopy(doc)) if (doc := self._docs.get(key)) else None
 
-    async def has_field(self, field: str) -> AsyncGenerator[KVPair, None]:
-        for doc in self.table.search(where(field).exists()):
-            yield KVPair.load(doc)
+    async def has_field(self, field: str, projection: Optional[List[str]] = None, batch_size: int = 256,
+                        after: Optional[str] = None) -> AsyncGenerator[KVPair, None]:
+        await self.create_index(field)
+        async for obj in self._scan(list(self._indexes[field]), projection, batch_size, after):
+            yield obj
 
     async def put(self, obj: KVPair) -> Tuple[Optional[KVPair], KVPair]:
-        if old_docs := self.table.search(where("key") == obj.key):
-            old_doc = old_docs[0]
-            doc = Document(obj.dump(), old_doc.doc_id)
-            self.table.write_back([doc])
-            return KVPair.load(old_doc), obj
-        else:
-            self.table.insert(obj.dump())
-            return None, obj
+        old_doc = self._docs.get(obj.key)
+        self._store(obj.dump())
+        self.database.schedule_flush()
+        return KVPair.load(old_doc) if old_doc else None, obj
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, KVPair]:
+        return {key: KVPair.load(deepcopy(doc)) for key in keys if (doc := self._docs.get(key))}
+
+    async def put_many(self, objs: Iterable[KVPair]) -> List[Tuple[Optional[KVPair], KVPair]]:
+        results = []
+        for obj in objs:
+            old_doc = self._docs.get(obj.key)
+            self._store(obj.dump())
+            results.append((KVPair.load(old_doc) if old_doc else None, obj))
+        if results:
+            self.database.schedule_flush()
+        return results
+
+    async def delete_many(self, objs: Iterable[KVPair]) -> List[KVPair]:
+        docs = [doc for obj in objs if (doc := self._docs.pop(obj.key, None))]
+        for doc in docs:
+            self._unindex(doc["key"])
+        if docs:
+            self.database.schedule_flush()
+        return [KVPair.load(doc) for doc in docs]
+
+    async def update(self, key: str, set_fields: Dict[str, Any], unset_fields: Iterable[str]) -> bool:
+        if (doc := self._docs.get(key)) is None:
+            return False
+        doc = {**doc, **set_fields}
+        for field in unset_fields:
+            doc.pop(field, None)
+        self._store(doc)
+        self.database.schedule_flush()
+        return True
 
 
 def get_container():
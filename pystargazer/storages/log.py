@@ -0,0 +1,281 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from typing import Any, AsyncGenerator, BinaryIO, Dict, Iterable, List, Optional, Set, Tuple
+from urllib.parse import parse_qsl, urlparse
+
+from pystargazer.models import AbstractKVContainer, EXPIRE_AT, KVPair
+from pystargazer.storages.expiry import ExpiryHeap
+from pystargazer.storages.snapshot import LazyTable, Snapshot
+from pystargazer.utils import dump_json, load_json
+
+
+class Log:
+    """
+    Append-only change log holding every table of one file, on top of a snapshot of the tables.
+
+    Each write appends one record. On startup the snapshot is memory-mapped and the records appended since are
+    replayed, so documents of the snapshot are only decoded when first accessed.
+    Records are written and synced by a dedicated thread, and once the log is larger than both compact_bytes and the
+    snapshot, the same thread writes the live documents into a new snapshot and starts the log over.
+
+    fsync is either "always", "never" or the minimum interval between two syncs in seconds.
+    """
+
+    def __init__(self, path: str, fsync: str = "1", compact_bytes: int = 16 << 20):
+        self.path = path
+        self.snapshot_path = f"{path}.snap"
+        self.fsync = fsync if fsync in ("always", "never") else float(fsync)
+        self.compact_bytes = compact_bytes
+
+        # stored documents are replaced, never mutated
+        self.tables: Dict[str, LazyTable] = {}
+        self.snapshot: Optional[Snapshot] = None
+        # bumped by every compaction, a log older than the snapshot is already part of it
+        self.generation = 0
+        self.size = 0
+        self.snapshot_size = 0
+        self._last_sync = time.monotonic()
+
+        self._pending: List[bytes] = []
+        self._flushing: Optional[asyncio.Future] = None
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="log-storage")
+
+        if dirname := os.path.dirname(path):
+            os.makedirs(dirname, exist_ok=True)
+        self._recover()
+        self._file: BinaryIO = open(path, mode="ab")
+
+    def _recover(self):
+        if os.path.exists(self.snapshot_path):
+            self.snapshot = Snapshot(self.snapshot_path)
+            self.generation = self.snapshot.generation
+            self.snapshot_size = os.path.getsize(self.snapshot_path)
+            self.tables = {name: LazyTable(name, self.snapshot) for name in self.snapshot.index}
+
+        if os.path.exists(self.path):
+            with open(self.path, mode="r+b") as f:
+                data = f.read()
+                # drop a record torn by a crash
+                if data and not data.endswith(b"\n"):
+                    logging.warning(f"Truncating torn record in storage log {self.path}.")
+                    data = data[:data.rfind(b"\n") + 1]
+                    f.truncate(len(data))
+
+            records = [load_json(line) for line in data.splitlines()]
+            generation = records[0]["generation"] if records and records[0]["op"] == "begin" else 0
+            if generation >= self.generation:
+                for record in records:
+                    self._replay(record)
+                self.size = len(data)
+                return
+            logging.info(f"Discarding storage log {self.path}, which is already part of its snapshot.")
+        self._reset(self.generation)
+
+    def _reset(self, generation: int):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, mode="wb") as f:
+            f.write(header := dump_json({"op": "begin", "generation": generation}) + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.size = len(header)
+
+    def table(self, name: str) -> LazyTable:
+        if (table := self.tables.get(name)) is None:
+            table = self.tables[name] = LazyTable(name)
+        return table
+
+    def _replay(self, record: dict):
+        if record["op"] == "begin":
+            return
+        table = self.table(record["table"])
+        if record["op"] == "put":
+            table[record["key"]] = record["doc"]
+        elif record["op"] == "update":
+            if doc := table.get(record["key"]):
+                doc.update(record["set"])
+                for field in record["unset"]:
+                    doc.pop(field, None)
+        elif record["op"] == "delete":
+            table.pop(record["key"], None)
+
+    def append(self, record: dict):
+        self._pending.append(dump_json(record) + b"\n")
+        if self._flushing is None or self._flushing.done():
+            self._flushing = asyncio.ensure_future(self._flush())
+
+    def _sync(self, force: bool = False):
+        if self.fsync == "never":
+            return
+        if force or self.fsync == "always" or time.monotonic() - self._last_sync >= self.fsync:
+            os.fsync(self._file.fileno())
+            self._last_sync = time.monotonic()
+
+    def _write(self, data: bytes):
+        self._file.write(data)
+        self._file.flush()
+        self._sync()
+
+    def _compact(self, entries: Dict[str, Tuple[LazyTable, list]]) -> Snapshot:
+        generation = self.generation + 1
+        tables = {name: table.encode(_entries) for name, (table, _entries) in entries.items()}
+        self.snapshot_size = Snapshot.write(self.snapshot_path, tables, generation)
+        self._file.close()
+        self._reset(generation)
+        self._file = open(self.path, mode="ab")
+        self.generation = generation
+        logging.info(f"Compacted storage log {self.path} into a snapshot of {self.snapshot_size} bytes.")
+        return Snapshot(self.snapshot_path)
+
+    async def _flush(self):
+        loop = asyncio.get_event_loop()
+        while self._pending:
+            data = b"".join(self._pending)
+            self._pending.clear()
+            # noinspection PyBroadException
+            try:
+                await loop.run_in_executor(self._writer, self._write, data)
+                self.size += len(data)
+                if self.size > max(self.compact_bytes, self.snapshot_size):
+                    # records appended meanwhile are already in the snapshot, replaying them again is harmless
+                    entries = {name: (table, list(table.entries())) for name, table in self.tables.items()}
+                    snapshot = await loop.run_in_executor(self._writer, self._compact, entries)
+                    # documents not decoded yet have the same encoding in the new snapshot
+                    for table in self.tables.values():
+                        table.snapshot = snapshot
+                    if self.snapshot is not None:
+                        self.snapshot.close()
+                    self.snapshot = snapshot
+            except Exception:
+                logging.exception(f"Failed to write storage log {self.path}.")
+
+    async def flush(self):
+        if self._flushing is not None:
+            await self._flushing
+        await asyncio.get_event_loop().run_in_executor(self._writer, self._sync, True)
+
+
+# logs by path, shared by the containers of every table stored in the same file
+_logs: Dict[str, Log] = {}
+
+
+def get_log(path: str, query: str = "") -> Log:
+    if (log := _logs.get(key := os.path.abspath(path))) is None:
+        options = dict(parse_qsl(query))
+        log = _logs[key] = Log(path, options.get("fsync", "1"), int(options.get("compact_bytes", 16 << 20)))
+    return log
+
+
+class LogKVContainer(AbstractKVContainer):
+    """
+    Table of an append-only log file, e.g. log://data/db.log/states?fsync=always.
+
+    The table is held in memory and serves every read, writes append a record of the change.
+    """
+
+    async def delete(self, obj: KVPair) -> KVPair:
+        doc = self._docs.pop(obj.key)
+        self._unindex(obj.key)
+        self.log.append({"table": self.name, "op": "delete", "key": obj.key})
+        return KVPair.load(doc)
+
+    async def iter(self, projection: Optional[List[str]] = None, batch_size: int = 256,
+                   after: Optional[str] = None) -> AsyncGenerator[KVPair, None]:
+        async for obj in self._scan(list(self._docs), projection, batch_size, after):
+            yield obj
+
+    def __init__(self, url: str):
+        super().__init__()
+        parsed_url = urlparse(url)
+        path = "/".join([
+            parsed_url.netloc,
+            *parsed_url.path[1:].split("/")[:-1]
+        ])
+        self.name = parsed_url.path.split("/")[-1]
+
+        self.log = get_log(path, parsed_url.query)
+        self._docs: LazyTable = self.log.table(self.name)
+
+        # field -> keys of the documents having the field, built on first use of the field
+        self._indexes: Dict[str, Set[str]] = {}
+
+        self._expiry = ExpiryHeap(self._expire)
+        for key, deadline in self._docs.deadlines():
+            self._expiry.set(key, deadline)
+
+    def _store(self, doc: dict):
+        self._docs[doc["key"]] = doc = deepcopy(doc)
+        for field, index in self._indexes.items():
+            if field in doc:
+                index.add(doc["key"])
+            else:
+                index.discard(doc["key"])
+        self._expiry.set(doc["key"], doc.get(EXPIRE_AT))
+        return doc
+
+    def _unindex(self, key: str):
+        for index in self._indexes.values():
+            index.discard(key)
+        self._expiry.set(key, None)
+
+    def _expire(self, key: str):
+        del self._docs[key]
+        self._unindex(key)
+        self.log.append({"table": self.name, "op": "delete", "key": key})
+
+    async def _scan(self, keys: Iterable[str], projection: Optional[List[str]], batch_size: int,
+                    after: Optional[str]) -> AsyncGenerator[KVPair, None]:
+        for i, key in enumerate(sorted(key for key in keys if after is None or key > after), 1):
+            if key in self._docs:
+                if projection == []:
+                    yield KVPair(key, {})
+                else:
+                    yield KVPair.load(deepcopy(self._docs[key])).project(projection)
+            if i % batch_size == 0:
+                # let other tasks run between batches
+                await asyncio.sleep(0)
+
+    async def create_index(self, field: str):
+        if field not in self._indexes:
+            self._indexes[field] = {key for key, doc in self._docs.items() if field in doc}
+
+    async def flush(self):
+        await self.log.flush()
+
+    async def get(self, key: str) -> KVPair:
+        return KVPair.load(deepcopy(doc)) if (doc := self._docs.get(key)) else None
+
+    async def has_field(self, field: str, projection: Optional[List[str]] = None, batch_size: int = 256,
+                        after: Optional[str] = None) -> AsyncGenerator[KVPair, None]:
+        await self.create_index(field)
+        async for obj in self._scan(list(self._indexes[field]), projection, batch_size, after):
+            yield obj
+
+    async def put(self, obj: KVPair) -> Tuple[Optional[KVPair], KVPair]:
+        old_doc = self._docs.get(obj.key)
+        doc = self._store(obj.dump())
+        self.log.append({"table": self.name, "op": "put", "key": obj.key, "doc": doc})
+        return KVPair.load(old_doc) if old_doc else None, obj
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, KVPair]:
+        return {key: KVPair.load(deepcopy(doc)) for key in keys if (doc := self._docs.get(key))}
+
+    async def update(self, key: str, set_fields: Dict[str, Any], unset_fields: Iterable[str]) -> bool:
+        if (doc := self._docs.get(key)) is None:
+            return False
+        unset_fields = list(unset_fields)
+        doc = {**doc, **set_fields}
+        for field in unset_fields:
+            doc.pop(field, None)
+        self._store(doc)
+        # only the patch is logged, so writing back a few fields of a large document stays cheap
+        self.log.append({"table": self.name, "op": "update", "key": key, "set": set_fields, "unset": unset_fields})
+        return True
+
+
+def get_container():
+    return LogKVContainer
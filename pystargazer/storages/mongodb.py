@@ -1,22 +1,58 @@
-from typing import AsyncGenerator, Optional, Tuple
-from urllib.parse import urlparse
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Any, AsyncGenerator, Dict, Iterable, List, Optional, Set, Tuple
+from urllib.parse import parse_qsl, urlencode, urlparse
 
 import motor.motor_asyncio
 from motor.core import AgnosticClient, AgnosticCollection, AgnosticDatabase
+from pymongo import ReplaceOne, ReturnDocument
 
 from pystargazer.app import app
-from pystargazer.models import AbstractKVContainer, KVPair
+from pystargazer.models import AbstractKVContainer, EXPIRE_AT, KVPair
+
+# clients shared by every container connecting to the same server with the same options
+_clients: Dict[str, AgnosticClient] = {}
+
+
+def get_client(host: str, db: str, query: str = "") -> AgnosticClient:
+    """
+    Get the shared client of a server.
+
+    Client options such as maxPoolSize or serverSelectionTimeoutMS are taken from the query string of the storage url,
+    e.g. mongodb://localhost/stargazer/vtubers?maxPoolSize=10&serverSelectionTimeoutMS=5000.
+    """
+    options = dict(parse_qsl(query))
+    if "@" in host:
+        # credentials are checked against the database in the url unless told otherwise
+        options.setdefault("authSource", db)
+    uri = f"mongodb://{host}/"
+    if options:
+        uri += f"?{urlencode(sorted(options.items()))}"
+
+    if (client := _clients.get(uri)) is None:
+        client = _clients[uri] = motor.motor_asyncio.AsyncIOMotorClient(uri)
+    return client
 
 
 class MongoKVContainer(AbstractKVContainer):
+    """ Collection of a MongoDB database, expired documents are removed by a TTL index on EXPIRE_AT. """
+
     async def delete(self, obj: KVPair) -> KVPair:
-        # TODO inconsistent behavior: won't return pop object like FileKVContainer
-        await self.collections.delete_one({"key": obj.key})
-        return obj
+        doc = await self.collections.find_one_and_delete({"key": obj.key})
+        return self._load(doc) if doc else obj
+
+    async def iter(self, projection: Optional[List[str]] = None, batch_size: int = 256,
+                   after: Optional[str] = None) -> AsyncGenerator[KVPair, None]:
+        async for doc in self._find({}, projection, batch_size, after):
+            yield self._load(doc)
 
-    async def iter(self) -> AsyncGenerator[KVPair, None]:
-        async for doc in self.collections.find():
-            yield KVPair.load(doc)
+    def _find(self, query: dict, projection: Optional[List[str]], batch_size: int, after: Optional[str]):
+        if after is not None:
+            query = {**query, "key": {"$gt": after}}
+        fields = {"_id": 0, "key": 1, **dict.fromkeys(projection, 1)} if projection is not None else None
+        # served in order by the unique key index
+        return self.collections.find(query, fields, batch_size=batch_size).sort("key", 1)
 
     def __init__(self, url: str):
         super().__init__()
@@ -24,25 +60,95 @@ class MongoKVContainer(AbstractKVContainer):
         host = parsed_url.netloc
         db, collection = parsed_url.path[1:].split("/")
 
-        self.client: AgnosticClient = motor.motor_asyncio.AsyncIOMotorClient(f"mongodb://{host}/{db}")
+        self.client: AgnosticClient = get_client(host, db, parsed_url.query)
         self.db: AgnosticDatabase = self.client[db]
         self.collections: AgnosticCollection = self.db[collection]
+        self._indexes: Set[str] = set()
+        self._key_index: Optional[asyncio.Future] = None
+
+    @staticmethod
+    def _load(doc: dict) -> KVPair:
+        if isinstance(expire_at := doc.get(EXPIRE_AT), datetime):
+            # TTL indexes only apply to dates, read back in UTC without a timezone
+            doc[EXPIRE_AT] = expire_at.replace(tzinfo=timezone.utc).timestamp()
+        return KVPair.load(doc)
+
+    @staticmethod
+    def _dump(obj: KVPair) -> dict:
+        doc = obj.dump()
+        if EXPIRE_AT in doc:
+            doc[EXPIRE_AT] = datetime.fromtimestamp(doc[EXPIRE_AT], timezone.utc)
+        return doc
+
+    async def _create_key_index(self):
+        # noinspection PyBroadException
+        try:
+            await self.collections.create_index("key", unique=True)
+            await self.collections.create_index(EXPIRE_AT, expireAfterSeconds=0)
+        except Exception:
+            logging.exception(f"Failed to create key indexes on {self.collections.full_name}.")
+
+    async def _ensure_key_index(self):
+        # the unique index keeps concurrent upserts of one key from inserting it twice
+        if self._key_index is None:
+            self._key_index = asyncio.ensure_future(self._create_key_index())
+        await self._key_index
+
+    async def create_index(self, field: str):
+        if field not in self._indexes:
+            # sparse, so the index only holds the documents having the field
+            await self.collections.create_index(field, sparse=True)
+            self._indexes.add(field)
 
     async def get(self, key: str) -> KVPair:
         doc: dict = await self.collections.find_one({"key": key})
-        return KVPair.load(doc) if doc else None
+        return self._load(doc) if doc else None
 
-    async def has_field(self, field: str) -> AsyncGenerator[KVPair, None]:
-        async for doc in self.collections.find({field: {"$exists": True}}):
-            yield KVPair.load(doc)
+    async def has_field(self, field: str, projection: Optional[List[str]] = None, batch_size: int = 256,
+                        after: Optional[str] = None) -> AsyncGenerator[KVPair, None]:
+        await self.create_index(field)
+        async for doc in self._find({field: {"$exists": True}}, projection, batch_size, after):
+            yield self._load(doc)
 
     async def put(self, obj: KVPair) -> Tuple[Optional[KVPair], KVPair]:
-        if old_doc := (await self.collections.find_one({"key": obj.key})):
-            await self.collections.replace_one({"_id": old_doc["_id"]}, obj.dump())
-            return KVPair.load(old_doc), obj
-        else:
-            await self.collections.insert_one(obj.dump())
-            return None, obj
+        await self._ensure_key_index()
+        old_doc = await self.collections.find_one_and_replace({"key": obj.key}, self._dump(obj), upsert=True,
+                                                              return_document=ReturnDocument.BEFORE)
+        return self._load(old_doc) if old_doc else None, obj
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, KVPair]:
+        return {doc["key"]: self._load(doc) async for doc in self.collections.find({"key": {"$in": list(keys)}})}
+
+    async def put_many(self, objs: Iterable[KVPair]) -> List[Tuple[Optional[KVPair], KVPair]]:
+        objs = list(objs)
+        if not objs:
+            return []
+        await self._ensure_key_index()
+        old_objs = await self.get_many(obj.key for obj in objs)
+        await self.collections.bulk_write([ReplaceOne({"key": obj.key}, self._dump(obj), upsert=True) for obj in objs])
+
+        results = []
+        for obj in objs:
+            results.append((old_objs.get(obj.key), obj))
+            old_objs[obj.key] = obj
+        return results
+
+    async def delete_many(self, objs: Iterable[KVPair]) -> List[KVPair]:
+        keys = [obj.key for obj in objs]
+        docs = [doc async for doc in self.collections.find({"key": {"$in": keys}})]
+        await self.collections.delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})
+        return [self._load(doc) for doc in docs]
+
+    async def update(self, key: str, set_fields: Dict[str, Any], unset_fields: Iterable[str]) -> bool:
+        update = {}
+        if EXPIRE_AT in set_fields:
+            set_fields = {**set_fields, EXPIRE_AT: datetime.fromtimestamp(set_fields[EXPIRE_AT], timezone.utc)}
+        if set_fields:
+            update["$set"] = set_fields
+        if unset_fields := {field: "" for field in unset_fields}:
+            update["$unset"] = unset_fields
+        result = await self.collections.update_one({"key": key}, update)
+        return result.matched_count > 0
 
 
 def get_container():
@@ -0,0 +1,155 @@
+import mmap
+import os
+import struct
+from typing import Dict, Iterable, Iterator, MutableMapping, Optional, Tuple
+from urllib.parse import urlparse
+
+from pystargazer.models import EXPIRE_AT
+from pystargazer.utils import dump_json, load_json
+
+MAGIC = b"PSGSNAP1"
+# index offset, index length, generation, magic
+FOOTER = struct.Struct("<QQQ8s")
+
+
+class Snapshot:
+    """
+    Read-only tables memory-mapped from a snapshot file.
+
+    The file holds the encoded documents followed by an index of their offsets by table and key, so opening it only
+    decodes the index and each document is decoded when it is first accessed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, mode="rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < len(MAGIC) + FOOTER.size:
+                raise ValueError(f"{path} is not a snapshot.")
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        index_offset, index_length, self.generation, magic = FOOTER.unpack_from(self._mmap, size - FOOTER.size)
+        if self._mmap[:len(MAGIC)] != MAGIC or magic != MAGIC:
+            self._mmap.close()
+            raise ValueError(f"{path} is not a snapshot.")
+        # table -> key -> [offset, length] or [offset, length, expire at]
+        self.index: Dict[str, Dict[str, list]] = load_json(self._mmap[index_offset:index_offset + index_length])
+
+    def raw(self, table: str, key: str) -> bytes:
+        offset, length = self.index[table][key][:2]
+        return self._mmap[offset:offset + length]
+
+    def deadline(self, table: str, key: str) -> Optional[float]:
+        entry = self.index[table][key]
+        return entry[2] if len(entry) > 2 else None
+
+    def load(self, table: str, key: str) -> dict:
+        return load_json(self.raw(table, key))
+
+    def close(self):
+        self._mmap.close()
+
+    @staticmethod
+    def write(path: str, tables: Dict[str, Iterable[Tuple[str, bytes, Optional[float]]]], generation: int) -> int:
+        """
+        Atomically replace the snapshot at path with the encoded documents of tables, return its size.
+
+        The expiry time of each document is kept in the index, so that it is known without decoding the document.
+        """
+        tmp_path = f"{path}.tmp"
+        index = {}
+        with open(tmp_path, mode="wb") as f:
+            f.write(MAGIC)
+            for table, docs in tables.items():
+                offsets = index[table] = {}
+                for key, doc, deadline in docs:
+                    offsets[key] = [f.tell(), len(doc)] if deadline is None else [f.tell(), len(doc), deadline]
+                    f.write(doc)
+            index_offset = f.tell()
+            f.write(encoded_index := dump_json(index))
+            f.write(FOOTER.pack(index_offset, len(encoded_index), generation, MAGIC))
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        os.replace(tmp_path, path)
+        return size
+
+
+class LazyTable(MutableMapping):
+    """ Documents of a table by key, those still in the snapshot are decoded on first access. """
+
+    def __init__(self, name: str, snapshot: Optional[Snapshot] = None):
+        self.name = name
+        self.snapshot = snapshot
+        self.docs: Dict[str, dict] = {}
+        self.lazy: Dict[str, None] = dict.fromkeys(snapshot.index.get(name, ())) if snapshot else {}
+
+    def __getitem__(self, key: str) -> dict:
+        if key in self.lazy:
+            self.docs[key] = self.snapshot.load(self.name, key)
+            del self.lazy[key]
+        return self.docs[key]
+
+    def __setitem__(self, key: str, doc: dict):
+        self.docs[key] = doc
+        self.lazy.pop(key, None)
+
+    def __delitem__(self, key: str):
+        if key in self.lazy:
+            del self.lazy[key]
+        else:
+            del self.docs[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self.docs or key in self.lazy
+
+    def __iter__(self) -> Iterator[str]:
+        return iter([*self.docs, *self.lazy])
+
+    def __len__(self) -> int:
+        return len(self.docs) + len(self.lazy)
+
+    def entries(self) -> Iterator[Tuple[str, Optional[dict]]]:
+        """ Key and document of every entry without decoding, the document is None if it is still in the snapshot. """
+        yield from self.docs.items()
+        yield from ((key, None) for key in self.lazy)
+
+    def encode(self, entries: Iterable[Tuple[str, Optional[dict]]]) -> Iterator[Tuple[str, bytes, Optional[float]]]:
+        for key, doc in entries:
+            if doc is not None:
+                yield key, dump_json(doc), doc.get(EXPIRE_AT)
+            else:
+                yield key, self.snapshot.raw(self.name, key), self.snapshot.deadline(self.name, key)
+
+    def deadlines(self) -> Iterator[Tuple[str, Optional[float]]]:
+        """ Key and expiry time of every document, without decoding those still in the snapshot. """
+        yield from ((key, doc.get(EXPIRE_AT)) for key, doc in self.docs.items())
+        yield from ((key, self.snapshot.deadline(self.name, key)) for key in self.lazy)
+
+
+async def convert(path: str, urls: Iterable[str]) -> int:
+    """ Write the tables at urls into the snapshot a log:// storage at path starts from. """
+    from pystargazer.models import KVContainer
+
+    tables = {}
+    for url in urls:
+        # noinspection PyProtectedMember
+        container = KVContainer._get_kv_container(url)
+        tables[urlparse(url).path.split("/")[-1]] = [(obj.key, dump_json(obj.dump()), obj.value.get(EXPIRE_AT))
+                                                     async for obj in container.iter()]
+    return Snapshot.write(f"{path}.snap", tables, 1)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from pystargazer.app import app
+
+    parser = argparse.ArgumentParser(description="Convert tables of any storage into a log storage snapshot.")
+    parser.add_argument("path", help="log file of the target log:// storage, e.g. data/db.log")
+    parser.add_argument("urls", nargs="+", help="storage url of every table, e.g. file://data/db.json/vtubers")
+    args = parser.parse_args()
+
+    if os.path.exists(args.path) or os.path.exists(f"{args.path}.snap"):
+        parser.error(f"{args.path} already exists.")
+    print(f"Wrote {app.loop.run_until_complete(convert(args.path, args.urls))} bytes to {args.path}.snap.")
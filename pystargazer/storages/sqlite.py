@@ -0,0 +1,255 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncGenerator, Callable, Dict, Iterable, List, Optional, Set, Tuple, TypeVar
+from urllib.parse import parse_qsl, urlparse
+
+from pystargazer.models import AbstractKVContainer, EXPIRE_AT, KVPair
+from pystargazer.utils import dump_json, load_json
+
+T = TypeVar("T")
+
+
+class Database:
+    """
+    SQLite database in WAL mode, accessed from a small pool of threads holding a connection each.
+
+    WAL lets the threads read concurrently while one of them writes.
+    """
+
+    def __init__(self, path: str, synchronous: str = "NORMAL", workers: int = 4):
+        self.path = path
+        self.synchronous = synchronous
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sqlite-storage")
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if (conn := getattr(self._local, "connection", None)) is None:
+            # transactions are opened explicitly
+            conn = self._local.connection = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        return conn
+
+    def run_sync(self, func: Callable[[sqlite3.Connection], T]) -> T:
+        return self._executor.submit(lambda: func(self.connection)).result()
+
+    async def run(self, func: Callable[[sqlite3.Connection], T]) -> T:
+        return await asyncio.get_event_loop().run_in_executor(self._executor, lambda: func(self.connection))
+
+
+# databases by path, shared by the containers of every table stored in the same file
+_databases: Dict[str, Database] = {}
+
+
+def get_database(path: str, query: str = "") -> Database:
+    if (db := _databases.get(key := os.path.abspath(path))) is None:
+        options = dict(parse_qsl(query))
+        db = _databases[key] = Database(path, options.get("synchronous", "NORMAL").upper(),
+                                         int(options.get("workers", "4")))
+    return db
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _field_path(field: str) -> str:
+    # JSON path of a top-level field as a SQL literal, indexes are only used by queries spelling it the same
+    return "'$." + _quote(field).replace("'", "''") + "'"
+
+
+class SqliteKVContainer(AbstractKVContainer):
+    """
+    Table of a SQLite database, e.g. sqlite:///data/db.sqlite/states for a relative path or
+    sqlite:////var/lib/stargazer/db.sqlite/states for an absolute one.
+
+    Documents are stored as JSON keyed by their primary key, has_field is served by partial expression indexes.
+    Expired documents are deleted every sweep_interval seconds.
+    """
+
+    sweep_interval = 60
+
+    def __init__(self, url: str):
+        super().__init__()
+        parsed_url = urlparse(url)
+        path, table = (parsed_url.netloc + parsed_url.path).rsplit("/", 1)
+
+        self.db = get_database(path[1:], parsed_url.query)
+        self.name = table
+        self.table = _quote(table)
+        self._indexes: Set[str] = set()
+
+        self._expire_at = f"json_extract(doc, {_field_path(EXPIRE_AT)})"
+        self.db.run_sync(self._create_table)
+        self._schedule_sweep(0)
+
+    def _create_table(self, conn: sqlite3.Connection):
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, doc TEXT NOT NULL) WITHOUT ROWID")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {_quote(f'{self.name}_expire_at')} ON {self.table} "
+                     f"({self._expire_at}) WHERE {self._expire_at} IS NOT NULL")
+
+    def _schedule_sweep(self, delay: float):
+        asyncio.get_event_loop().call_later(delay, lambda: asyncio.ensure_future(self._sweep()))
+
+    async def _sweep(self):
+        now = time.time()
+        # noinspection PyBroadException
+        try:
+            await self.db.run(lambda conn: conn.execute(
+                f"DELETE FROM {self.table} WHERE {self._expire_at} <= ?", (now,)))
+        except Exception:
+            logging.exception(f"Failed to delete expired documents of {self.name} in {self.db.path}.")
+        self._schedule_sweep(self.sweep_interval)
+
+    @staticmethod
+    def _load(doc: Optional[str]) -> Optional[KVPair]:
+        return KVPair.load(load_json(doc)) if doc is not None else None
+
+    @staticmethod
+    def _dump(obj: KVPair) -> str:
+        return dump_json(obj.dump()).decode("utf-8")
+
+    def _select(self, conn: sqlite3.Connection, key: str) -> Optional[str]:
+        row = conn.execute(f"SELECT doc FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _select_many(self, conn: sqlite3.Connection, keys: List[str]) -> Dict[str, str]:
+        docs = {}
+        # stay below the host parameter limit of old SQLite builds
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            docs.update(conn.execute(f"SELECT key, doc FROM {self.table} WHERE key IN ({','.join('?' * len(chunk))})",
+                                     chunk))
+        return docs
+
+    @staticmethod
+    def _transaction(conn: sqlite3.Connection, func: Callable[[], T]) -> T:
+        # take the write lock upfront, so that the documents read stay current until commit
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = func()
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+
+    async def _scan(self, where: str, projection: Optional[List[str]], batch_size: int,
+                    after: Optional[str]) -> AsyncGenerator[KVPair, None]:
+        # keys only are read from the index alone
+        columns = "key, NULL" if projection == [] else "key, doc"
+        # pages by key instead of holding a cursor, which can't be shared by the threads of the pool
+        query = f"SELECT {columns} FROM {self.table} WHERE {where} ORDER BY key LIMIT ?"
+        next_query = f"SELECT {columns} FROM {self.table} WHERE {where} AND key > ? ORDER BY key LIMIT ?"
+        last_key = after
+        while True:
+            if last_key is None:
+                rows = await self.db.run(lambda conn: conn.execute(query, (batch_size,)).fetchall())
+            else:
+                rows = await self.db.run(lambda conn: conn.execute(next_query, (last_key, batch_size)).fetchall())
+            for key, doc in rows:
+                yield KVPair(key, {}) if doc is None else self._load(doc).project(projection)
+            if len(rows) < batch_size:
+                break
+            last_key = rows[-1][0]
+
+    async def create_index(self, field: str):
+        if field not in self._indexes:
+            index = _quote(f"{self.name}_has_{field}")
+            await self.db.run(lambda conn: conn.execute(
+                f"CREATE INDEX IF NOT EXISTS {index} ON {self.table} (key) "
+                f"WHERE json_type(doc, {_field_path(field)}) IS NOT NULL"))
+            self._indexes.add(field)
+
+    async def get(self, key: str) -> KVPair:
+        return self._load(await self.db.run(lambda conn: self._select(conn, key)))
+
+    async def has_field(self, field: str, projection: Optional[List[str]] = None, batch_size: int = 256,
+                        after: Optional[str] = None) -> AsyncGenerator[KVPair, None]:
+        await self.create_index(field)
+        async for obj in self._scan(f"json_type(doc, {_field_path(field)}) IS NOT NULL", projection, batch_size, after):
+            yield obj
+
+    async def iter(self, projection: Optional[List[str]] = None, batch_size: int = 256,
+                   after: Optional[str] = None) -> AsyncGenerator[KVPair, None]:
+        async for obj in self._scan("TRUE", projection, batch_size, after):
+            yield obj
+
+    async def put(self, obj: KVPair) -> Tuple[Optional[KVPair], KVPair]:
+        doc = self._dump(obj)
+
+        def put(conn: sqlite3.Connection) -> Optional[str]:
+            old_doc = self._select(conn, obj.key)
+            conn.execute(f"INSERT INTO {self.table} (key, doc) VALUES (?, ?) "
+                         f"ON CONFLICT (key) DO UPDATE SET doc = excluded.doc", (obj.key, doc))
+            return old_doc
+
+        return self._load(await self.db.run(lambda conn: self._transaction(conn, lambda: put(conn)))), obj
+
+    async def delete(self, obj: KVPair) -> KVPair:
+        def delete(conn: sqlite3.Connection) -> Optional[str]:
+            if (old_doc := self._select(conn, obj.key)) is not None:
+                conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (obj.key,))
+            return old_doc
+
+        return self._load(await self.db.run(lambda conn: self._transaction(conn, lambda: delete(conn)))) or obj
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, KVPair]:
+        keys = list(keys)
+        docs = await self.db.run(lambda conn: self._select_many(conn, keys))
+        return {key: self._load(doc) for key, doc in docs.items()}
+
+    async def put_many(self, objs: Iterable[KVPair]) -> List[Tuple[Optional[KVPair], KVPair]]:
+        objs = list(objs)
+        rows = [(obj.key, self._dump(obj)) for obj in objs]
+
+        def put_many(conn: sqlite3.Connection) -> Dict[str, str]:
+            old_docs = self._select_many(conn, list({obj.key for obj in objs}))
+            conn.executemany(f"INSERT INTO {self.table} (key, doc) VALUES (?, ?) "
+                             f"ON CONFLICT (key) DO UPDATE SET doc = excluded.doc", rows)
+            return old_docs
+
+        old_objs = {key: self._load(doc) for key, doc in
+                    (await self.db.run(lambda conn: self._transaction(conn, lambda: put_many(conn)))).items()}
+        results = []
+        for obj in objs:
+            results.append((old_objs.get(obj.key), obj))
+            old_objs[obj.key] = obj
+        return results
+
+    async def delete_many(self, objs: Iterable[KVPair]) -> List[KVPair]:
+        keys = list({obj.key for obj in objs})
+
+        def delete_many(conn: sqlite3.Connection) -> Dict[str, str]:
+            old_docs = self._select_many(conn, keys)
+            conn.executemany(f"DELETE FROM {self.table} WHERE key = ?", [(key,) for key in old_docs])
+            return old_docs
+
+        old_docs = await self.db.run(lambda conn: self._transaction(conn, lambda: delete_many(conn)))
+        return [self._load(doc) for doc in old_docs.values()]
+
+    async def update(self, key: str, set_fields: Dict[str, Any], unset_fields: Iterable[str]) -> bool:
+        unset_fields = list(unset_fields)
+        set_doc = dump_json(set_fields)
+
+        def update(conn: sqlite3.Connection) -> bool:
+            if (doc := self._select(conn, key)) is None:
+                return False
+            doc = load_json(doc)
+            doc.update(load_json(set_doc))
+            for field in unset_fields:
+                doc.pop(field, None)
+            conn.execute(f"UPDATE {self.table} SET doc = ? WHERE key = ?", (dump_json(doc).decode("utf-8"), key))
+            return True
+
+        return await self.db.run(lambda conn: self._transaction(conn, lambda: update(conn)))
+
+
+def get_container():
+    return SqliteKVContainer
@@ -1,8 +1,25 @@
-from typing import Tuple
+import json
+from typing import Any, Iterable, Optional, Tuple
 from distutils.util import strtobool as _strtobool
 
+try:
+    import orjson
 
-def compare_dict(d1, d2) -> Tuple[dict, dict, dict]:
+    def dump_json(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+    load_json = orjson.loads
+except ModuleNotFoundError:
+    def dump_json(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    load_json = json.loads
+
+
+def compare_dict(d1, d2, keys: Optional[Iterable[str]] = None) -> Tuple[dict, dict, dict]:
+    if keys is not None:
+        d1 = {k: d1[k] for k in keys if k in d1}
+        d2 = {k: d2[k] for k in keys if k in d2}
     set_1 = set(d1)
     set_2 = set(d2)
     added = {k: d2[k] for k in set_2 - set_1}
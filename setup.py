@@ -33,7 +33,8 @@ setup(
         extras_require={
             'mongo': ['motor'],
             'files': ['tinydb==3.15.2'],
-            'telemetry': ['sentry-sdk']
+            'telemetry': ['sentry-sdk'],
+            'speedups': ['orjson']
         },
         python_requires='>=3.8'
 )